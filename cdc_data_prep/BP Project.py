@@ -3,7 +3,7 @@
 
 # # Import pre-cleaned data
 
-# The raw data file 'LLCP2017.XPT' includes over 300 variables, mostly intermediate or in a form that cannot be directy analyzed. Interpretting variable names requires referencing the provided codebook ('codebook17_llcp-v2-508.pdf'). The python file 'data_import.py' converts this raw file to a properly formatted and usable analytic dataframe (andf). It also contains the raw file as a pandas dataframe (cdcdf_full), a dictionary of values for categorical variables (value_dict, extracted in a messy-but-workable fashion from the codebook pdf), a dictionary of variables and corresponding questions (v_and_q_dict), and a text string that summarizes the preprocessing steps executed in the data_import.py file (data_description). 
+# The raw data file 'LLCP2017.XPT' includes over 300 variables, mostly intermediate or in a form that cannot be directy analyzed. Interpretting variable names requires referencing the provided codebook ('codebook17_llcp-v2-508.pdf'). The python file 'data_import.py' converts this raw file to a properly formatted and usable analytic dataframe (andf). It also streams the analytic columns of the raw file into the dataset store (llcp2017) and saves a dictionary of values for categorical variables (value_dict, extracted in a messy-but-workable fashion from the codebook pdf), a dictionary of variables and corresponding questions (v_and_q_dict), and a text string that summarizes the preprocessing steps executed in the data_import.py file (data_description). 
 
 # In[60]:
 
@@ -11,9 +11,6 @@
 import numpy as np
 import pandas as pd
 import pickle
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.impute import SimpleImputer
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import confusion_matrix, classification_report
 from sklearn.model_selection import RepeatedStratifiedKFold
@@ -25,39 +22,38 @@ import xgboost as xgb
 from xgboost import plot_importance
 from matplotlib import pyplot as plt
 
-# Helps with quick ID of variables
-def search_string(x, only_andf=True):
-    if only_andf:
-        output =  [(i, v_and_q_dict[i]) for i in v_and_q_dict      if x.lower() in v_and_q_dict[i].lower() and i in andf.columns]
-    if not only_andf:
-        output = [(i, v_and_q_dict[i]) for i in v_and_q_dict                 if x.lower() in v_and_q_dict[i].lower()]
-    return output
+from codebook import decode_value_dict
+from codebook_index import store_index
+from dataset_store import DatasetStore
+from missingness import missing_profile
+from preprocess import BRFSSPreprocessor
 
-# Get column names after onehot for cats
-def get_names(varlist,cats):
-    output = [[m+str(n)              for m,n in zip([varlist[i]+'_']*len(cats[i]),
-                            cats[i])] for i in range(len(varlist))]
-    return [i for j in output for i in j]
+# Helps with quick ID of variables (ranked matches on variable names,
+# questions and value labels, see codebook_index.py)
+def search_string(x, only_andf=True):
+    return codebook_index.search(x, columns=andf.columns if only_andf
+                                 else None)
 
 
 # In[61]:
 
 
-# Read in data_import dict generated from data_import.py 
-data_import = pickle.load( open( "data_import.pickle", "rb" ) )
+# Read in the dataset store written by data_import.py 
+store = DatasetStore('data_store')
 
 # State ranks if necessary
 state_ranks = pickle.load( open( "state_ranks.pickle", "rb" ) )
 
 # Get andf, v_and_q_dict, and value_dict
-andf = data_import['andf']
-v_and_q_dict = data_import['v_and_q_dict']
-value_dict = data_import['value_dict']
+andf = store.read('andf')
+v_and_q_dict = store.read_meta('v_and_q_dict')
+value_dict = decode_value_dict(store.read_meta('value_dict'))
+codebook_index = store_index(store)
 
 # # Re-attach state, then output csv for MLM in R
-# pd.concat([data_import['cdcdf_full']['_STATE'],
+# pd.concat([store.read('llcp2017', columns=['_STATE'])['_STATE'],
 #           andf],axis=1).to_csv('andf.csv')
-andf['_STATE'] = data_import['cdcdf_full']['_STATE']
+andf['_STATE'] = store.read('llcp2017', columns=['_STATE'])['_STATE']
 
 
 # # DV, train/val/test, impute/standardize
@@ -65,9 +61,10 @@ andf['_STATE'] = data_import['cdcdf_full']['_STATE']
 # In[62]:
 
 
-# Drop > 20% missing by row
-propmiss = andf.apply(lambda x: sum(x.isna())/len(x), axis=1)
-andf = andf.loc[propmiss<.2,:].copy()
+# Drop > 20% missing by row (missingness profile, including the re-attached
+# _STATE, is cached in the store until andf is rewritten)
+profile = missing_profile(store, 'andf', andf)
+andf = profile.keep_rows(andf, .2)
 
 # DV prep, drop nan from '_RFHYPE5_Yes 18' (ever been told high bp)
 andf = andf.loc[~andf['_RFHYPE5_Yes 18'].isna(),:].copy()
@@ -108,24 +105,10 @@ conts = [i for i in x_train if x_train[i].dtypes!='object' and          len(x_tr
 cats = [i for i in x_train if i in catdums         and len(x_train[i].value_counts())>2]
 dums = [i for i in x_train if i not in conts and i not in cats]
 
-# Deal with imputing
-catimpute = SimpleImputer(strategy='most_frequent')
-contimpute = SimpleImputer(strategy='mean')
-catimpute.fit(x_train[catdums])
-contimpute.fit(x_train[conts])
-
-# Impute based on x_train
-x_train[catdums] = catimpute.transform(x_train[catdums])
-x_train[conts] = contimpute.transform(x_train[conts])
-x_val[catdums] = catimpute.transform(x_val[catdums])
-x_val[conts] = contimpute.transform(x_val[conts])
-x_test[catdums] = catimpute.transform(x_test[catdums])
-x_test[conts] = contimpute.transform(x_test[conts])
-
-
-# Make onehot and standardized
-std = StandardScaler().fit(x_train[conts])
-onehot = OneHotEncoder(categories='auto').fit(x_train[cats])
+# Impute, scale and onehot in one fitted transformer (see preprocess.py),
+# fit on x_train. Its fitted state is kept in the store.
+prep = BRFSSPreprocessor(dums, conts, cats).fit(x_train)
+store.write_meta('preprocessor', prep.to_dict())
 
 
 # In[67]:
@@ -139,26 +122,11 @@ pd.DataFrame(y_test).to_csv('y_test.csv')
 # In[54]:
 
 
-# Make prep function (transforms fit on x_train)
-def xprep(X,
-          cats=cats,dums=dums,conts=conts,
-          std=std,onehot=onehot):
-    return pd.concat([X[dums],
-                      pd.DataFrame(std.transform(X[conts]),
-                                   columns=conts,
-                                   index=X.index),
-                      pd.DataFrame(onehot.transform(X[cats]).toarray(),
-                                   columns=get_names(cats,onehot.categories_),
-                                   index=X.index)],axis=1)
-
-
-# In[55]:
-
-
-# Update x_train/val for 
-x_train = xprep(x_train)
-x_val = xprep(x_val)
-x_test = xprep(x_test)
+# Update x_train/val/test (dense frames for the csv/store outputs; 
+# prep.transform gives the sparse matrix for models)
+x_train = prep.transform_frame(x_train)
+x_val = prep.transform_frame(x_val)
+x_test = prep.transform_frame(x_test)
 
 
 # In[56]:
@@ -179,20 +147,29 @@ x_val.drop('_STATE',axis=1,inplace=True)
 x_test.drop('_STATE',axis=1,inplace=True)
 
 # Save list of cat/ord/dum/cont variables
-pd.DataFrame({'cats':cats}).to_csv('cats.csv', index=False)
-pd.DataFrame({'catdums':catdums}).to_csv('catdums.csv', index=False)
-pd.DataFrame({'conts':conts}).to_csv('conts.csv', index=False)
-pd.DataFrame({'dums':dums}).to_csv('dums.csv', index=False)
+store.write_meta('cats', cats)
+store.write_meta('catdums', catdums)
+store.write_meta('conts', conts)
+store.write_meta('dums', dums)
 
 
 # In[57]:
 
 
-# pickle train/val/test x,y - make future testing faster
-pickle.dump(x_train, open('x_train.pickle', 'wb'))
-pickle.dump(x_val, open('x_val.pickle', 'wb'))
-pickle.dump(x_test, open('x_test.pickle', 'wb'))
-pickle.dump(y_train, open('y_train.pickle', 'wb'))
-pickle.dump(y_val, open('y_val.pickle', 'wb'))
-pickle.dump(y_test, open('y_test.pickle', 'wb'))
+# Store train/val/test x,y - make future testing faster (e.g.
+# store.read('x_train', columns=conts) loads only those columns)
+for name, split in [('x_train', x_train), ('x_val', x_val), 
+                    ('x_test', x_test), ('y_train', y_train), 
+                    ('y_val', y_val), ('y_test', y_test)]:
+    store.write(name, split)
+
+
+
+# # Tuning
 
+# Hyperparameters for XGBoost and SVC are searched with successive halving
+# on the stored splits (see tuning.py), from the command line since it
+# takes a while and resumes from its cache if interrupted:
+# python tuning.py xgb --n_jobs 4
+# python tuning.py svc --n_jobs 4
+# The best params are kept in the store, e.g. store.read_meta('tuning_xgb')
@@ -0,0 +1,283 @@
+'''Builds andf for one or many BRFSS survey years.
+
+The stages of data_import.py are functions here (enrich adds the state
+indicators, encode makes the ordinal/dummy/region columns), and build_years
+runs ingest -> codebook -> recode -> enrich -> encode for each year in a
+process pool. Variable names are harmonized across years through the
+codebooks (see harmonize_names), so e.g. a computed variable whose suffix
+changed between years gets the reference year's name.
+
+The result is partitioned by year: each year is a DatasetStore in
+<store>/years/<year>/ (frames llcp<year> and andf, plus its dicts), and the
+root store's manifest lists the partitions. read_years concatenates them:
+
+    python build.py --survey 2017 LLCP2017.XPT codebook17_llcp-v2-508.pdf \
+                    --survey 2016 LLCP2016.XPT codebook16_llcp.pdf --n_jobs 4
+
+    andf = read_years('data_store', columns=['_BMI5', '_RFHYPE5_Yes 18'])
+'''
+import argparse
+import os
+import pickle
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from sklearn.preprocessing import LabelBinarizer
+
+from codebook import load_codebook, encode_value_dict
+from dataset_store import DatasetStore
+from ingest import ingest_xpt
+from missingness import missing_profile
+
+# Add gdp_pc, income_ineq, pop_dens_km, partisan_lean, and census_region
+state_vars = ['gdp_pc', 'income_ineq', 'pop_dens_km',
+              'partisan_lean', 'census_region']
+
+# ID all object vars with > 2 categories
+# cat_cand = [i for i in andf if andf[i].dtypes=='O' \
+#             and len(andf[i].value_counts())>2]
+# print(cat_cand)
+# # Manually inspect these varaibles and ID ordinal vs. cats
+# ordinal_vars = []
+# for var in cat_cand:
+#     print(value_dict[var])
+#     iscand = input(var+' ? ')
+#     if iscand=='y':
+#         ordinal_vars.append(var)
+# print(ordinal_vars)
+ordinal_vars = ['_ASTHMS1', '_LMTACT1', '_LMTWRK1', '_LMTSCL1', '_BMI5CAT',
+                '_CHLDCNT', '_EDUCAG', '_INCOMG', '_SMOKER3', '_ECIGSTS',
+                '_PA150R2', '_PA300R2']
+
+data_description = '''The dataframe andf (analytic dataframe) does not include variables that
+references sequences, phone type, or weights. It also drops other variables
+that I considered unnecessary or redundent:
+
+'_STSTR', '_STRWT', '_RAWRAKE', '_WT2RAKE', '_LLCPWT',
+'_RFHLTH', '_PHYS14D', '_MENT14D', '_IMPRACE', '_PRACE1',
+'_MRACE1', '_HISPANC', '_RACE', '_RACEG21',
+'_AGEG5YR', '_AGE65YR', '_AGE_G', '_RFSMOK3',
+'_CURECIG', '_MISFRT1', '_MISVEG1', '_FRT16A', '_VEG23A',
+'_FRUITE1', '_VEGETE1', '_PACAT1', '_PA30021', '_PASTAE1',
+'_RFSEAT2', '_PSU'
+
+andf does not include intermediate variables (those ending with _).
+
+Any values with dont know, refused, or missing were recoded as nan.
+
+Variables with >20% missing were dropped.
+
+Variables deemed to be continous were kept as floats, all others were
+coded as objects.
+
+The _STATE variable was converted to other numerical state-level indicators
+(see state_label), then dropped. Those state_label vars were convereted to dummies.
+
+Categorical variables with only 2 levels were renamed and recoded as simple binary
+dummies.
+
+'''
+
+# ordinal_vars (and BP Project.py) use the 2017 names, so other years are
+# harmonized to 2017 when it is built
+reference_year = '2017'
+
+def find_cats(andf, value_dict):
+    '''Vars whose value labels are all codes (no ranges)'''
+    return [var for var in andf if var in value_dict and
+            sum([type(i) is str for i in value_dict[var].keys()])==0]
+
+def enrich(andf, value_dict, state_ranks):
+    '''Replaces _STATE with the state level indicators in state_ranks'''
+    andf['state_label'] = andf['_STATE'].map(value_dict['_STATE'])
+    state_table = pd.DataFrame({key: pd.Series(state_ranks[key])
+                                for key in state_vars})
+    andf = andf.join(state_table, on='state_label')
+    # States without a census_region are binarized as 'None' (as before)
+    andf['census_region'] = andf['census_region'].astype(object).fillna('None')
+    return andf.drop(['_STATE', 'state_label'], axis=1)
+
+def encode(andf, value_dict):
+    '''Ordinal vars to float, 2-cardinal cats to binary dummies and
+    census_region to region dummies. Returns andf and the dummy names.'''
+    # Change ordinal object vars to float
+    ordinals = [i for i in ordinal_vars if i in andf]
+    andf[ordinals] = andf[ordinals].astype('float')
+
+    # Convert 2-cardinal cats to binary dummies
+    twocats = [var for var in andf if len(andf[var].value_counts())==2 \
+               and var in value_dict]
+    renames = dict(zip(twocats,
+                   [i+'_'+value_dict[i][2][:6] for i in twocats]))
+    andf = andf.rename(index=str,columns=renames)
+    dums = [i for i in renames.values()]
+    andf[dums] = andf[dums]-1
+    andf[dums] = andf[dums].astype('float')
+
+    # Get dummies for census_region
+    lb = LabelBinarizer()
+    lb.fit(andf['census_region'].astype(str))
+    andf = pd.concat([andf.reset_index(drop=True),
+                      pd.DataFrame(lb.transform(
+                          andf['census_region'].astype(str)),
+                          columns=['Region_'+ i for i in lb.classes_])],
+                     axis=1)
+    andf.drop(['census_region'],axis=1,inplace=True)
+
+    # Make ints floats
+    intvars = [i for i in andf.columns if andf[i].dtypes=='int']
+    andf[intvars] = andf[intvars].astype('float')
+    return andf, dums
+
+def analytic_frame(store, name, value_dict, state_ranks, missing=.2,
+                   renames=None):
+    '''andf from the ingested frame name of store: drops columns with more
+    than missing missing, renames (see harmonize_names), then types cats,
+    enriches and encodes'''
+    andf = store.read(name)
+    andf = missing_profile(store, name, andf).drop_columns(andf, missing)
+    if renames:
+        andf = andf.rename(columns=renames)
+    cats = find_cats(andf, value_dict)
+    andf[cats] = andf[cats].astype('object')
+    return encode(enrich(andf, value_dict, state_ranks), value_dict)[0]
+
+def _normalize(question):
+    return ' '.join(question.lower().split())
+
+def _stem(var):
+    # Computed var names get a new trailing number when they are revised
+    return re.sub(r'\d+$', '', var)
+
+def harmonize_names(v_and_qs, reference):
+    '''Maps each year's variables to the reference year's names.
+    v_and_qs is {year: v_and_q}. A variable that is not in the reference
+    year is renamed to the reference variable with the same question (and,
+    if several have it, the same name apart from a trailing number). Returns
+    {year: {name: reference name}}.'''
+    ref = v_and_qs[reference]
+    by_question = {}
+    for var, question in zip(ref['Variable'], ref['Question']):
+        by_question.setdefault(_normalize(question), []).append(var)
+    renames = {}
+    for year, v_and_q in v_and_qs.items():
+        names = set(v_and_q['Variable'])
+        year_renames = {}
+        for var, question in zip(v_and_q['Variable'], v_and_q['Question']):
+            if var in by_question.get(_normalize(question), []):
+                continue
+            candidates = [i for i in by_question.get(_normalize(question), [])
+                          if i not in names]
+            if len(candidates) > 1:
+                candidates = [i for i in candidates if _stem(i) == _stem(var)]
+            if len(candidates) == 1:
+                year_renames[var] = candidates[0]
+        # Two vars mapped to one name would collide, leave them as they are
+        targets = Counter(year_renames.values())
+        renames[year] = {k: v for k, v in year_renames.items()
+                         if targets[v] == 1}
+    return renames
+
+def rename_codebook(codebook, renames):
+    '''Returns v_and_q_dict and value_dict under the harmonized names'''
+    v_and_q = codebook['v_and_q']
+    v_and_q_dict = {renames.get(k, k): v for k, v in
+                    zip(v_and_q['Variable'], v_and_q['Question'])}
+    value_dict = {renames.get(k, k): v for k, v in
+                  codebook['value_dict'].items()}
+    return v_and_q_dict, value_dict
+
+def year_path(root, year):
+    return os.path.join(root, 'years', str(year))
+
+def build_year(year, xpt_path, pdf_path, root, renames, state_ranks_path,
+               cache_dir='codebook_cache', chunksize=50000, missing=.2):
+    '''Builds one year's partition. Returns (year, rows, columns).'''
+    codebook = load_codebook(pdf_path, cache_dir)
+    store = DatasetStore(year_path(root, year))
+    name = 'llcp' + str(year)
+    if name not in store:
+        ingest_xpt(xpt_path, codebook, store, name, chunksize)
+    # The raw frame keeps the year's own names, the partition's andf and
+    # dicts use the harmonized ones
+    v_and_q_dict, value_dict = rename_codebook(codebook, renames)
+    with open(state_ranks_path, 'rb') as f:
+        state_ranks = pickle.load(f)
+    andf = analytic_frame(store, name, value_dict, state_ranks, missing,
+                          renames)
+    andf.insert(0, 'year', int(year))
+    store.write('andf', andf)
+    store.write_meta('data_description', data_description)
+    store.write_meta('value_dict', encode_value_dict(value_dict))
+    store.write_meta('v_and_q_dict', v_and_q_dict)
+    store.write_meta('renames', renames)
+    return year, len(andf), len(andf.columns)
+
+def build_years(surveys, root='data_store', state_ranks_path='state_ranks.pickle',
+                reference=None, n_jobs=1, cache_dir='codebook_cache',
+                chunksize=50000, missing=.2):
+    '''Builds each (year, xpt_path, codebook_pdf) in surveys, n_jobs years
+    at a time (-1 for all cores). Names are harmonized to the reference
+    year (default reference_year if built, else the latest). Returns
+    {year: (rows, columns)}.'''
+    years = [str(i[0]) for i in surveys]
+    if reference is None:
+        reference = reference_year if reference_year in years else max(years)
+    reference = str(reference)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max(1, min(n_jobs, len(surveys)))) \
+            as pool:
+        # Parse (or read the cached) codebooks first, each PDF once, since
+        # harmonizing needs all of them
+        pdfs = sorted(set(i[2] for i in surveys))
+        codebooks = dict(zip(pdfs, pool.map(load_codebook, pdfs,
+                                            [cache_dir]*len(pdfs))))
+        renames = harmonize_names({str(year): codebooks[pdf]['v_and_q']
+                                   for year, xpt, pdf in surveys}, reference)
+        # Each year writes its own store, so workers never share a manifest
+        futures = [pool.submit(build_year, str(year), xpt, pdf, root,
+                               renames[str(year)], state_ranks_path,
+                               cache_dir, chunksize, missing)
+                   for year, xpt, pdf in surveys]
+        built = [i.result() for i in futures]
+    store = DatasetStore(root)
+    store.write_meta('years', {year: {'path': year_path(root, year),
+                                      'rows': rows, 'columns': columns}
+                               for year, rows, columns in built})
+    store.write_meta('years_reference', reference)
+    return {year: (rows, columns) for year, rows, columns in built}
+
+def read_years(root='data_store', years=None, columns=None):
+    '''Concatenates the andf partitions of years (default all built) with
+    a year column. Columns missing from a year are nan.'''
+    partitions = DatasetStore(root).read_meta('years')
+    frames = []
+    for year in (years or sorted(partitions)):
+        store = DatasetStore(partitions[str(year)]['path'])
+        read_columns = None
+        if columns is not None:
+            read_columns = ['year'] + [i for i in columns if i != 'year'
+                                       and i in store.columns('andf')]
+        frames.append(store.read('andf', columns=read_columns))
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build andf for several BRFSS survey years')
+    parser.add_argument('--survey', nargs=3, action='append', required=True,
+                        metavar=('YEAR', 'XPT', 'CODEBOOK_PDF'))
+    parser.add_argument('--store', default='data_store')
+    parser.add_argument('--state_ranks', default='state_ranks.pickle')
+    parser.add_argument('--reference', help='year whose variable names are '
+                        'used (default 2017 if built, else the latest)')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='years built at once (-1 for all cores)')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    args = parser.parse_args()
+    built = build_years(args.survey, args.store, args.state_ranks,
+                        args.reference, args.n_jobs,
+                        chunksize=args.chunksize)
+    for year, (rows, columns) in sorted(built.items()):
+        print(year, rows, 'rows,', columns, 'columns')
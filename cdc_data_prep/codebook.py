@@ -0,0 +1,245 @@
+'''Parses the BRFSS codebook PDF into v_and_q (variable names and
+questions), the filtered value label tables and value_dict, with a cache.
+
+Parsing (textract for the text, tabula for the tables) takes minutes, so
+results are stored in cache_dir/<sha256 of the pdf>/ as csv/json and only
+rebuilt when the PDF or PARSER_VERSION changes:
+
+    codebook = load_codebook('information/codebook17_llcp-v2-508.pdf')
+    codebook['value_dict']['_STATE']
+
+To rebuild from the command line (pages split across processes):
+    python codebook.py information/codebook17_llcp-v2-508.pdf --n_jobs 4
+'''
+import argparse
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Bump when the parsing below changes so cached codebooks are rebuilt
+PARSER_VERSION = 1
+
+def pdf_checksum(path):
+    '''sha256 of file contents'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def extract_v_and_q(pdf_path):
+    '''Returns df of Variable (SAS name) and Question'''
+    import textract
+    text = textract.process(pdf_path, encoding='utf-8')
+    text = text.splitlines()
+    text = [i.decode('utf-8') for i in text]
+    v_and_q = pd.DataFrame({
+        'Variable': [i.split(':')[1].strip() for i in text
+                     if 'SAS Variable Name' in i],
+        'Question': [i.split(':')[1].strip() for i in text
+                     if 'Question:' in i]
+    })
+    v_and_q.drop_duplicates(inplace=True)
+    v_and_q.reset_index(drop=True,inplace=True)
+    return v_and_q
+
+def _read_pages(pdf_path, pages):
+    from tabula import read_pdf
+    return read_pdf(pdf_path, multiple_tables=True, pages=pages)
+
+def page_chunks(pages, n_chunks):
+    '''Splits a 'first-last' page range into up to n_chunks ranges'''
+    first, last = [int(i) for i in pages.split('-')]
+    return ['%d-%d' % (i[0], i[-1]) for i in
+            np.array_split(np.arange(first, last + 1), n_chunks) if len(i)]
+
+def extract_tables(pdf_path, pages='2-195', n_jobs=1):
+    '''Returns all tables on pages (tabula), in page order. n_jobs > 1
+    splits the pages across a process pool.'''
+    if n_jobs == 1:
+        return _read_pages(pdf_path, pages)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    chunks = page_chunks(pages, n_jobs)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+        results = pool.map(_read_pages, [pdf_path]*len(chunks), chunks)
+        return [table for tables in results for table in tables]
+
+def filter_tables(alltables):
+    '''Keeps the variable name and value/label rows of each table'''
+    alltables = [i.loc[~i[0].isna(),:].reset_index(drop=True)
+                 for i in alltables]
+    filtered_tables = []
+    for table in alltables:
+        filt = []
+        ind = False
+        for i in range(len(table[0])):
+            filt.append(ind)
+            if 'Type of Variable:' in table[0][i]:
+                ind = True
+            if 'SAS Variable Name:' in table[0][i]:
+                ind = False
+            if 'Value Value Label' in table[0][i]:
+                ind = True
+            if 'BLANK' in table[0][i]:
+                ind = False
+            if 'HIDDEN' in table[0][i]:
+                ind = False
+        filtered_tables.append(table.loc[filt,0].reset_index(drop=True))
+    return filtered_tables
+
+def ex_value_dicts(exlist):
+    # Remove floats, add ' None' to keys with no values
+    exlist = [i + ' None' if len(i.split())==1 else i for i in exlist]
+    outlist = [[i.split(':')[1].strip(), np.nan] \
+                   if 'SAS Variable Name:' in i \
+               else [' '.join(i.split(' ')[0:3]),
+                    ' '.join(i.split(' ')[3:])] \
+                   if i.split(' ')[0].isdigit() and i.split(' ')[1]=='-'
+               else [i.split(' ')[0],
+                    ' '.join(i.split(' ')[1:])] for i in exlist
+    ]
+
+    outlist = [[i[0],i[1][:25]] \
+               if type(i[1]) is str else i \
+               for i in outlist]
+
+    varname = outlist[0][0].split(' ')[0]
+    outdict = {d[0]: d[1] for d in outlist[1:]}
+
+    # Drop stray invalid keys (whack a mole)
+    outdict = {d[0]: d[1] for d in \
+               [[i, outdict[i]] \
+                for i in outdict \
+                if i[0].isdigit() and ',' not in i and \
+                'HIDDEN' not in i and 'BLANK' not in i]}
+
+    outdict = dict(zip([float(i) if i[0].isdigit() and '-' not in i \
+                        and ')' not in i
+                        else i for i in outdict.keys()],
+                       outdict.values()))
+    return varname, outdict
+
+def build_value_dict(filtered_tables):
+    '''Returns {variable: {value: label}}, merging tables split across
+    pages'''
+    dict_list = []
+    for table in filtered_tables:
+        dict_list.append(ex_value_dicts(table))
+
+    value_dict = {}
+    for i in range(len(dict_list)-1):
+        if dict_list[i][0] == dict_list[i+1][0]:
+            value_dict[dict_list[i][0]] = {**dict_list[i][1],
+                                           **dict_list[i+1][1]}
+        if i > 0 and dict_list[i][0] != dict_list[i-1][0]:
+            value_dict[dict_list[i][0]] = dict_list[i][1]
+
+    # Add the last dict
+    value_dict[dict_list[len(dict_list)-1][0]] = \
+        dict_list[len(dict_list)-1][1]
+    return value_dict
+
+def parse_codebook(pdf_path, pages='2-195', n_jobs=1, tables_pickle=None):
+    '''Parses the codebook without the cache. tables_pickle is an optional
+    pickle of the raw tabula tables (e.g. alltables.pickle) to use instead
+    of re-reading the PDF.'''
+    if tables_pickle is not None and os.path.exists(tables_pickle):
+        alltables = pickle.load(open(tables_pickle, 'rb'))
+    else:
+        alltables = extract_tables(pdf_path, pages, n_jobs)
+    filtered_tables = filter_tables(alltables)
+    return {
+        'v_and_q': extract_v_and_q(pdf_path),
+        'filtered_tables': filtered_tables,
+        'value_dict': build_value_dict(filtered_tables),
+    }
+
+def encode_value_dict(value_dict):
+    '''json-ready value_dict. Keys are floats (codes) or strings (ranges),
+    so they are stored as [key, label] pairs to keep their type.'''
+    return {var: [[k, v] for k, v in labels.items()]
+            for var, labels in value_dict.items()}
+
+def decode_value_dict(encoded):
+    '''Inverse of encode_value_dict'''
+    return {var: {k: v for k, v in pairs} for var, pairs in encoded.items()}
+
+def cache_path(pdf_path, cache_dir='codebook_cache'):
+    '''Cache directory for this PDF's contents'''
+    return os.path.join(cache_dir, pdf_checksum(pdf_path))
+
+def write_cache(path, codebook, pdf_path, pages):
+    os.makedirs(path, exist_ok=True)
+    # Files derived from a previous parse (e.g. the search index) are stale
+    if os.path.exists(os.path.join(path, 'index.json')):
+        os.remove(os.path.join(path, 'index.json'))
+    codebook['v_and_q'].to_csv(os.path.join(path, 'v_and_q.csv'),
+                               index=False)
+    with open(os.path.join(path, 'filtered_tables.json'), 'w') as f:
+        json.dump([i.tolist() for i in codebook['filtered_tables']], f,
+                  indent=1)
+    with open(os.path.join(path, 'value_dict.json'), 'w') as f:
+        json.dump(encode_value_dict(codebook['value_dict']), f, indent=1)
+    # Manifest last, so a partly written cache is never read
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump({'pdf': os.path.basename(pdf_path),
+                   'sha256': os.path.basename(path),
+                   'parser_version': PARSER_VERSION,
+                   'pages': pages}, f, indent=1)
+
+def read_cache(path, pages=None):
+    '''Returns cached codebook, or None if missing, from another parser
+    version or (if pages is given) parsed from other pages'''
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('parser_version') != PARSER_VERSION:
+        return None
+    if pages is not None and manifest.get('pages') != pages:
+        return None
+    with open(os.path.join(path, 'filtered_tables.json')) as f:
+        filtered_tables = [pd.Series(i, name=0) for i in json.load(f)]
+    with open(os.path.join(path, 'value_dict.json')) as f:
+        value_dict = decode_value_dict(json.load(f))
+    return {
+        'v_and_q': pd.read_csv(os.path.join(path, 'v_and_q.csv'),
+                               dtype=str, keep_default_na=False),
+        'filtered_tables': filtered_tables,
+        'value_dict': value_dict,
+    }
+
+def load_codebook(pdf_path, cache_dir='codebook_cache', pages='2-195',
+                  n_jobs=1, tables_pickle=None, rebuild=False):
+    '''Returns dict of v_and_q, filtered_tables and value_dict for the
+    codebook PDF, parsing it only if the cache has no entry for its
+    contents (or rebuild)'''
+    path = cache_path(pdf_path, cache_dir)
+    codebook = None if rebuild else read_cache(path, pages)
+    if codebook is None:
+        codebook = parse_codebook(pdf_path, pages, n_jobs, tables_pickle)
+        write_cache(path, codebook, pdf_path, pages)
+    return codebook
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Parse and cache a BRFSS codebook PDF')
+    parser.add_argument('pdf')
+    parser.add_argument('--cache_dir', default='codebook_cache')
+    parser.add_argument('--pages', default='2-195')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='processes for table extraction (-1 for all '
+                        'cores)')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+    codebook = load_codebook(args.pdf, args.cache_dir, args.pages,
+                             args.n_jobs, rebuild=args.rebuild)
+    print(len(codebook['v_and_q']), 'variables,',
+          len(codebook['value_dict']), 'value label dicts in',
+          cache_path(args.pdf, args.cache_dir))
@@ -0,0 +1,144 @@
+'''Indexed search over codebook variable names, questions and value labels.
+
+CodebookIndex keeps a trigram inverted index of each variable's name,
+question and value_dict labels. A query is looked up through the trigrams
+it contains and the candidates are checked for the substring, so results
+match a full scan (as search_string did) without scanning. Hits are ranked:
+exact name, then name, question and label matches.
+
+    index = store_index(DatasetStore('data_store'))
+    index.search('blood pressure', columns=andf.columns)
+
+store_index builds from the v_and_q_dict/value_dict that data_import.py
+saved in the dataset store and keeps it as codebook_index.json in the
+store directory, rebuilt when those change, so searching needs neither the
+PDF nor the parsing dependencies. load_index builds from the PDF instead
+and stores index.json in the codebook's cache directory (see codebook.py).
+'''
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+from codebook import load_codebook, cache_path, decode_value_dict
+
+INDEX_VERSION = 1
+GRAM = 3
+
+# Rank of a match in each field (higher first)
+field_weights = {'name': 3, 'question': 2, 'labels': 1}
+
+def grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+class CodebookIndex(object):
+    '''Trigram index over (variable, question, labels) documents'''
+    def __init__(self, docs, postings=None):
+        # docs: list of [variable, question, labels text]
+        self.docs = docs
+        self.lower = [{'name': var.lower(), 'question': question.lower(),
+                       'labels': labels.lower()}
+                      for var, question, labels in docs]
+        if postings is None:
+            postings = defaultdict(set)
+            for doc_id, fields in enumerate(self.lower):
+                for text in fields.values():
+                    for gram in grams(text):
+                        postings[gram].add(doc_id)
+        self.postings = {gram: set(ids) for gram, ids in postings.items()}
+
+    @classmethod
+    def build(cls, v_and_q_dict, value_dict=None):
+        '''Index from {variable: question} and value_dict labels'''
+        value_dict = value_dict or {}
+        variables = list(v_and_q_dict) + [i for i in value_dict
+                                          if i not in v_and_q_dict]
+        return cls([[var, v_and_q_dict.get(var, ''),
+                     ' | '.join(str(i) for i in
+                                value_dict.get(var, {}).values())]
+                    for var in variables])
+
+    def _candidates(self, query):
+        query_grams = grams(query)
+        if not query_grams:
+            # Shorter than a trigram, check every doc
+            return range(len(self.docs))
+        postings = sorted((self.postings.get(i, set()) for i in query_grams),
+                          key=len)
+        return set.intersection(*postings)
+
+    def search(self, query, columns=None, fields=('name', 'question',
+                                                  'labels')):
+        '''Returns ranked [(variable, question)] for variables whose fields
+        contain query (case insensitive). columns limits results to those
+        variables (e.g. andf.columns).'''
+        query = query.lower()
+        if columns is not None:
+            columns = set(columns)
+        hits = []
+        for doc_id in self._candidates(query):
+            var, question, labels = self.docs[doc_id]
+            if columns is not None and var not in columns:
+                continue
+            doc = self.lower[doc_id]
+            score = max([field_weights[i] for i in fields if query in doc[i]]
+                        or [0])
+            if score == 0:
+                continue
+            if doc['name'] == query:
+                score += len(field_weights)
+            hits.append((-score, doc_id))
+        return [(self.docs[doc_id][0], self.docs[doc_id][1])
+                for _, doc_id in sorted(hits)]
+
+    def save(self, path, source=None):
+        '''source identifies what the index was built from (checked by
+        load)'''
+        with open(path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'source': source,
+                       'docs': self.docs,
+                       'postings': {gram: sorted(ids) for gram, ids in
+                                    self.postings.items()}}, f)
+
+    @classmethod
+    def load(cls, path, source=None):
+        '''Returns saved index, or None if missing, another version or built
+        from another source'''
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if saved.get('version') != INDEX_VERSION or \
+                saved.get('source') != source:
+            return None
+        return cls(saved['docs'], saved['postings'])
+
+def load_index(pdf_path, cache_dir='codebook_cache'):
+    '''Returns the index for a codebook PDF, building and caching it next
+    to the parsed codebook the first time'''
+    path = os.path.join(cache_path(pdf_path, cache_dir), 'index.json')
+    index = CodebookIndex.load(path)
+    if index is None:
+        codebook = load_codebook(pdf_path, cache_dir)
+        v_and_q = codebook['v_and_q']
+        index = CodebookIndex.build(
+            dict(zip(v_and_q['Variable'], v_and_q['Question'])),
+            codebook['value_dict'])
+        index.save(path)
+    return index
+
+def store_index(store):
+    '''Returns the index for the v_and_q_dict/value_dict meta of a
+    DatasetStore, building and saving it in the store directory when they
+    have changed'''
+    v_and_q_dict = store.read_meta('v_and_q_dict')
+    encoded = store.read_meta('value_dict')
+    source = hashlib.sha256(json.dumps([v_and_q_dict, encoded],
+                                       sort_keys=True).encode()).hexdigest()
+    path = os.path.join(store.path, 'codebook_index.json')
+    index = CodebookIndex.load(path, source)
+    if index is None:
+        index = CodebookIndex.build(v_and_q_dict, decode_value_dict(encoded))
+        index.save(path, source)
+    return index
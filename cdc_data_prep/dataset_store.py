@@ -0,0 +1,136 @@
+'''Columnar on-disk store for the BRFSS frames (andf, the raw file, x/y
+train/val/test splits) and small metadata (variable lists, dicts).
+
+Each frame is an Arrow IPC (Feather v2) file, zstd compressed by default,
+and is read with column projection and memory mapping, so a step that
+needs two columns of the raw file does not load all of it:
+
+    store = DatasetStore('data_store')
+    store.write('andf', andf)
+    state = store.read('llcp2017', columns=['_STATE'])
+
+A manifest.json in the store lists the frames (index, object columns,
+whether a frame was a Series) and holds the json metadata. R can read the
+frames with arrow::read_feather.
+'''
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+class DatasetStore(object):
+    '''Directory of feather frames plus a json manifest'''
+    def __init__(self, path, compression='zstd'):
+        self.path = path
+        self.compression = compression
+        os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'frames': {}, 'meta': {}}
+
+    def _save_manifest(self):
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.feather')
+
+    def __contains__(self, name):
+        return name in self.manifest['frames']
+
+    def write(self, name, df):
+        '''Writes a df (or Series) as frame name, replacing it'''
+        is_series = isinstance(df, pd.Series)
+        if is_series:
+            df = df.to_frame()
+        # Object columns of numbers come back as floats from arrow, so
+        # remember them (cats are identified by dtype downstream)
+        object_columns = [str(i) for i in df.columns
+                          if df[i].dtype == object]
+        table = pa.Table.from_pandas(df, preserve_index=None)
+        feather.write_feather(table, self._file(name),
+                              compression=self.compression)
+        self.manifest['frames'][name] = {
+            'rows': len(df),
+            'columns': [str(i) for i in df.columns],
+            'index_columns': [i for i in table.schema.pandas_metadata[
+                'index_columns'] if isinstance(i, str)],
+            'object_columns': object_columns,
+            'series': is_series,
+            'written': time.time(),
+        }
+        self._save_manifest()
+
+    def write_chunks(self, name, chunks):
+        '''Writes an iterable of dfs with the same columns as frame name,
+        one record batch per df, without holding them all in memory'''
+        writer = None
+        rows = 0
+        try:
+            for df in chunks:
+                table = pa.Table.from_pandas(df, preserve_index=True)
+                if writer is None:
+                    schema = table.schema
+                    object_columns = [str(i) for i in df.columns
+                                      if df[i].dtype == object]
+                    writer = pa.ipc.new_file(
+                        self._file(name), schema,
+                        options=pa.ipc.IpcWriteOptions(compression=(
+                            None if self.compression == 'uncompressed'
+                            else self.compression)))
+                writer.write_table(table.cast(schema))
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            raise ValueError('no chunks to write for ' + name)
+        index_columns = [i for i in schema.pandas_metadata['index_columns']
+                         if isinstance(i, str)]
+        self.manifest['frames'][name] = {
+            'rows': rows,
+            'columns': [i for i in schema.names if i not in index_columns],
+            'index_columns': index_columns,
+            'object_columns': object_columns,
+            'series': False,
+            'written': time.time(),
+        }
+        self._save_manifest()
+
+    def read(self, name, columns=None, memory_map=True):
+        '''Reads frame name (only columns, if given). Returns a Series if a
+        Series was written and columns is None.'''
+        info = self.manifest['frames'][name]
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns) + info['index_columns']
+        table = feather.read_table(self._file(name), columns=read_columns,
+                                   memory_map=memory_map)
+        df = table.to_pandas()
+        object_columns = [i for i in info['object_columns']
+                          if i in df.columns]
+        if object_columns:
+            df[object_columns] = df[object_columns].astype(object)
+        if info['series'] and columns is None:
+            return df.iloc[:, 0]
+        return df
+
+    def columns(self, name):
+        return list(self.manifest['frames'][name]['columns'])
+
+    def written(self, name):
+        '''Time frame name was last written (None for older stores)'''
+        return self.manifest['frames'][name].get('written')
+
+    def write_meta(self, name, value):
+        '''Stores a json-serializable value (lists, dicts, strings)'''
+        self.manifest['meta'][name] = value
+        self._save_manifest()
+
+    def read_meta(self, name):
+        return self.manifest['meta'][name]
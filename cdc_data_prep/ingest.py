@@ -0,0 +1,137 @@
+'''Chunked ingest of the raw BRFSS SAS transport (XPT) files.
+
+The raw file has 300+ variables and almost all of them are dropped later,
+so the XPT is read chunksize rows at a time and each chunk keeps only the
+analytic variables (keepvars, from the codebook), gets the rounding fix
+and the dont know/refused/missing recode, and is appended to a frame in the
+dataset store. Peak memory follows the chunk and the kept columns, not the
+whole file. Several survey years can be ingested in one run:
+
+    python ingest.py --survey 2017 LLCP2017.XPT codebook17_llcp-v2-508.pdf \
+                     --survey 2016 LLCP2016.XPT codebook16_llcp.pdf
+'''
+import argparse
+import numpy as np
+import pandas as pd
+
+from codebook import load_codebook
+from dataset_store import DatasetStore
+
+# Unnecessary/redundant vars
+extra_dropvars = ['_STSTR', '_STRWT', '_RAWRAKE', '_WT2RAKE', '_LLCPWT',
+'_RFHLTH', '_PHYS14D', '_MENT14D', '_IMPRACE', '_PRACE1',
+'_MRACE1', '_HISPANC', '_RACE', '_RACEG21',
+'_AGEG5YR', '_AGE65YR', '_AGE_G', '_RFSMOK3',
+'_CURECIG', '_MISFRT1', '_MISVEG1', '_FRT16A', '_VEG23A',
+'_FRUITE1', '_VEGETE1', '_PACAT1', '_PA30021', '_PASTAE1',
+'_RFSEAT2', '_PSU']
+
+# Raw (non-computed) vars that are formatted correctly
+raw_keepvars = ['_STATE', 'PHYSHLTH', 'MENTHLTH', 'SEX', 'MARITAL']
+
+def drop_variables(v_and_q):
+    '''Variables whose question references sequence, phone or weight, plus
+    extra_dropvars'''
+    dropvars = [v_and_q['Variable'][i] \
+                       for i in range(len(v_and_q['Variable'])) if \
+                       'phone' in v_and_q['Question'][i].lower() \
+                       or 'sequence' in v_and_q['Question'][i].lower() \
+                       or 'weight' in v_and_q['Question'][i].lower()]
+    return dropvars + extra_dropvars
+
+def keep_variables(columns, dropvars):
+    '''Specified relevant vars and computed vars (other vars are not
+    formatted correctly), in file order'''
+    dropvars = set(dropvars)
+    return [i for i in columns if i not in dropvars and
+            (i in raw_keepvars or i[0] == '_')]
+
+def make_miss_dicts(value_dict):
+    '''Make dont know/refused/missing = np.nan and convert 88/888 to 0
+    dictionaries'''
+    miss_dicts = {}
+    for var in value_dict:
+        miss_dicts[var] = {**{k: np.nan for k in value_dict[var].keys() \
+                           if 'refused' in value_dict[var][k].lower() \
+                           or "don’t know" in value_dict[var][k].lower() \
+                           or "don't know" in value_dict[var][k].lower() \
+                           or "missing" in value_dict[var][k].lower()},
+                          **{k: 0 for k in value_dict[var].keys() \
+                           if k==88.0 or k==888.0}}
+    return miss_dicts
+
+def recode_tables(miss_dicts, columns):
+    '''Compiles miss_dicts into a {column: {code: new value}} table for
+    DataFrame.replace. Codes that can't match a float column (e.g. '1 - 30')
+    are dropped.'''
+    tables = {}
+    for var in columns:
+        table = {k: v for k, v in miss_dicts.get(var, {}).items()
+                 if not isinstance(k, str)}
+        if table:
+            tables[var] = table
+    return tables
+
+def prepare_chunk(chunk, keepvars, tables):
+    '''Projects, rounds and recodes one chunk of the raw file'''
+    chunk = chunk[keepvars]
+    # Fix import rounding errors (e.g. 0.7e-80 instead of 0)
+    chunk = chunk.round(5)
+    # One vectorized replace over all columns (matches are found before any
+    # values are replaced, so new values are never recoded again)
+    return chunk.replace(tables)
+
+def iter_xpt(xpt_path, keepvars, tables, chunksize=50000):
+    '''Yields prepared chunks of the XPT file'''
+    reader = pd.read_sas(xpt_path, format='xport', encoding='utf-8',
+                         chunksize=chunksize)
+    try:
+        start = 0
+        for chunk in reader:
+            # Keep the row numbers of the full file
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield prepare_chunk(chunk, keepvars, tables)
+    finally:
+        reader.close()
+
+def xpt_columns(xpt_path):
+    '''Variable names in an XPT file, without reading any rows'''
+    reader = pd.read_sas(xpt_path, format='xport', encoding='utf-8',
+                         iterator=True)
+    try:
+        return list(reader.columns)
+    finally:
+        reader.close()
+
+def ingest_xpt(xpt_path, codebook, store, name, chunksize=50000):
+    '''Streams the XPT into frame name of store (DatasetStore) and returns
+    the kept variables'''
+    dropvars = drop_variables(codebook['v_and_q'])
+    keepvars = keep_variables(xpt_columns(xpt_path), dropvars)
+    tables = recode_tables(make_miss_dicts(codebook['value_dict']), keepvars)
+    store.write_chunks(name, iter_xpt(xpt_path, keepvars, tables, chunksize))
+    return keepvars
+
+def ingest_surveys(surveys, store, chunksize=50000, cache_dir='codebook_cache'):
+    '''Ingests each (year, xpt_path, codebook_pdf) into frame 'llcp<year>'.
+    Returns {year: keepvars}'''
+    kept = {}
+    for year, xpt_path, pdf_path in surveys:
+        codebook = load_codebook(pdf_path, cache_dir)
+        kept[year] = ingest_xpt(xpt_path, codebook, store, 'llcp' + str(year),
+                                chunksize)
+    return kept
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Ingest BRFSS XPT files into the dataset store')
+    parser.add_argument('--survey', nargs=3, action='append', required=True,
+                        metavar=('YEAR', 'XPT', 'CODEBOOK_PDF'))
+    parser.add_argument('--store', default='data_store')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    args = parser.parse_args()
+    kept = ingest_surveys(args.survey, DatasetStore(args.store),
+                          args.chunksize)
+    for year, keepvars in kept.items():
+        print(year, len(keepvars), 'variables')
@@ -0,0 +1,70 @@
+'''Row and column missingness profile for the BRFSS frames.
+
+The fractions of missing values per row and per column come from one
+vectorized isna pass and are cached in the dataset store next to the
+frame they describe, so trying another cutoff is just a comparison:
+
+    profile = missing_profile(store, 'llcp2017')
+    andf = profile.drop_columns(andf, .2)
+
+The cached profile is recomputed when its source frame is rewritten.
+'''
+import pandas as pd
+
+class MissingProfile(object):
+    '''Fractions of missing values by column (indexed by column name) and
+    by row (indexed like the frame)'''
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def from_frame(cls, df):
+        na = df.isna().to_numpy()
+        return cls(pd.Series(na.mean(axis=0), index=df.columns),
+                   pd.Series(na.mean(axis=1), index=df.index))
+
+    def drop_columns(self, df, threshold):
+        '''Drops columns with more than threshold missing'''
+        return df.drop(self.columns.index[self.columns > threshold], axis=1)
+
+    def keep_rows(self, df, threshold):
+        '''Keeps rows with less than threshold missing'''
+        return df.loc[self.rows.loc[df.index] < threshold, :].copy()
+
+    def save(self, store, name, source=None):
+        '''Caches the profile in store (DatasetStore) under name, tied to
+        the current version of frame source'''
+        store.write(name + '_missing_rows', self.rows.rename('missing'))
+        store.write_meta(name + '_missing', {
+            'source': source,
+            'source_written': store.written(source) if source else None,
+            'columns': self.columns.to_dict(),
+        })
+
+    @classmethod
+    def load(cls, store, name, source=None):
+        '''Returns cached profile name, or None if there is none or source
+        was rewritten after it was computed'''
+        try:
+            meta = store.read_meta(name + '_missing')
+        except KeyError:
+            return None
+        if source and (meta['source'] != source or meta['source_written']
+                       != store.written(source)):
+            return None
+        return cls(pd.Series(meta['columns']),
+                   store.read(name + '_missing_rows'))
+
+def missing_profile(store, name, df=None, source=None):
+    '''Returns the cached profile name, computing (and caching) it from df
+    if there is none or it is stale. df defaults to frame source, and
+    source to name.'''
+    source = name if source is None else source
+    profile = MissingProfile.load(store, name, source)
+    if profile is None:
+        if df is None:
+            df = store.read(source)
+        profile = MissingProfile.from_frame(df)
+        profile.save(store, name, source)
+    return profile
@@ -0,0 +1,137 @@
+'''Fit-once preprocessing for the BRFSS x frames (replaces xprep in
+BP Project.py).
+
+BRFSSPreprocessor learns, on x_train, the mode of each dummy/categorical,
+the mean of each continuous var, the scaling of the mean-imputed continuous
+vars and the one-hot categories. transform then imputes, scales and one-hot
+encodes in one pass over each chunk of rows and returns a sparse matrix
+(dums, conts, then one-hot columns; see feature_names_):
+
+    prep = BRFSSPreprocessor(dums, conts, cats).fit(x_train)
+    X = prep.transform(x_new)          # scipy.sparse csr
+    x_val = prep.transform_frame(x_val)  # dense df, as xprep
+
+to_dict/from_dict round trip the fitted state through json (e.g. the
+dataset store's metadata).
+'''
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import StandardScaler
+
+class BRFSSPreprocessor(BaseEstimator, TransformerMixin):
+    '''Mode imputes dums and cats, mean imputes and standardizes conts and
+    one-hot encodes cats. chunksize rows are transformed at a time.'''
+    def __init__(self, dums, conts, cats, chunksize=100000):
+        self.dums = dums
+        self.conts = conts
+        self.cats = cats
+        self.chunksize = chunksize
+
+    def fit(self, X, y=None):
+        catdums = list(self.dums) + list(self.cats)
+        catimpute = SimpleImputer(strategy='most_frequent')
+        catimpute.fit(X[catdums])
+        contimpute = SimpleImputer(strategy='mean')
+        contimpute.fit(X[self.conts])
+        self.modes_ = catimpute.statistics_.astype(float)
+        self.means_ = contimpute.statistics_.astype(float)
+
+        # Scaling and categories are learned on the imputed x_train
+        std = StandardScaler().fit(contimpute.transform(X[self.conts]))
+        self.scale_mean_ = std.mean_
+        self.scale_ = std.scale_
+        # Sorted unique values, as OneHotEncoder(categories='auto')
+        cats = catimpute.transform(X[catdums])[:, len(self.dums):]
+        self.categories_ = [np.unique(cats[:, k].astype(float))
+                            for k in range(cats.shape[1])]
+        return self
+
+    @property
+    def feature_names_(self):
+        # Get column names after onehot for cats
+        return (list(self.dums) + list(self.conts) +
+                [var + '_' + str(cat) for var, cats in
+                 zip(self.cats, self.categories_) for cat in cats])
+
+    def _dense(self, X):
+        '''Imputed dums and imputed, standardized conts'''
+        n_dums = len(self.dums)
+        dums = X[self.dums].to_numpy(dtype=float)
+        dums = np.where(np.isnan(dums), self.modes_[:n_dums], dums)
+        conts = X[self.conts].to_numpy(dtype=float)
+        conts = np.where(np.isnan(conts), self.means_, conts)
+        conts -= self.scale_mean_
+        conts /= self.scale_
+        return np.hstack([dums, conts])
+
+    def _one_hot(self, X):
+        '''Sparse one-hot of the mode-imputed cats'''
+        cats = X[self.cats].to_numpy(dtype=float)
+        cats = np.where(np.isnan(cats), self.modes_[len(self.dums):], cats)
+        indices = np.empty(cats.shape, dtype=np.int64)
+        offset = 0
+        for k, categories in enumerate(self.categories_):
+            idx = np.searchsorted(categories, cats[:, k]).clip(
+                0, len(categories) - 1)
+            found = categories[idx] == cats[:, k]
+            if not found.all():
+                raise ValueError('Found unknown categories %s in column %s '
+                                 'during transform' %
+                                 (np.unique(cats[~found, k]).tolist(),
+                                  self.cats[k]))
+            indices[:, k] = idx + offset
+            offset += len(categories)
+        return sparse.csr_matrix(
+            (np.ones(indices.size), indices.ravel(),
+             np.arange(len(cats) + 1)*indices.shape[1]),
+            shape=(len(cats), offset))
+
+    def iter_transform(self, X):
+        '''Yields the transformed (csr) rows of X, chunksize at a time'''
+        for start in range(0, len(X), self.chunksize):
+            chunk = X.iloc[start:start + self.chunksize]
+            yield sparse.hstack([sparse.csr_matrix(self._dense(chunk)),
+                                 self._one_hot(chunk)], format='csr')
+
+    def transform(self, X, y=None):
+        '''Returns csr matrix with columns feature_names_'''
+        return sparse.vstack(list(self.iter_transform(X)), format='csr')
+
+    def transform_frame(self, X):
+        '''Returns dense df with columns feature_names_ and X's index'''
+        return pd.concat([
+            pd.DataFrame(np.hstack([self._dense(chunk),
+                                    self._one_hot(chunk).toarray()]),
+                         columns=self.feature_names_, index=chunk.index)
+            for chunk in [X.iloc[start:start + self.chunksize]
+                          for start in range(0, len(X), self.chunksize)]
+        ])
+
+    def to_dict(self):
+        '''json-ready fitted state'''
+        return {
+            'dums': list(self.dums),
+            'conts': list(self.conts),
+            'cats': list(self.cats),
+            'chunksize': self.chunksize,
+            'modes': self.modes_.tolist(),
+            'means': self.means_.tolist(),
+            'scale_mean': self.scale_mean_.tolist(),
+            'scale': self.scale_.tolist(),
+            'categories': [i.tolist() for i in self.categories_],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        prep = cls(state['dums'], state['conts'], state['cats'],
+                   state['chunksize'])
+        prep.modes_ = np.array(state['modes'], dtype=float)
+        prep.means_ = np.array(state['means'], dtype=float)
+        prep.scale_mean_ = np.array(state['scale_mean'], dtype=float)
+        prep.scale_ = np.array(state['scale'], dtype=float)
+        prep.categories_ = [np.array(i, dtype=float)
+                            for i in state['categories']]
+        return prep
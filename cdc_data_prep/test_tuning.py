@@ -0,0 +1,22 @@
+import numpy as np
+
+from tuning import SuccessiveHalving, svc_space
+
+def test_schedule_ends_at_max_resources():
+    search = SuccessiveHalving('svc', svc_space, n_candidates=5, factor=3,
+                               max_resources=300)
+    schedule = search._schedule(1000)
+    assert len(schedule) == 2
+    assert schedule[-1] == 300
+
+def test_last_round_compares_candidates_at_max_resources(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(240, 4)
+    y = (X[:, 0] + rng.randn(240) > 0).astype(int)
+    search = SuccessiveHalving('svc', svc_space, n_candidates=5, factor=3,
+                               max_resources=120, cache_dir=str(tmp_path))
+    search.fit(X, y)
+    last = search.results_[search.results_['round'] ==
+                           search.results_['round'].max()]
+    assert (last['rows'] == 120).all()
+    assert len(last) == 2
@@ -0,0 +1,254 @@
+'''Successive halving hyperparameter search for the BP classifiers.
+
+A repeated-CV randomized search refits every candidate on all of x_train
+in every fold. SuccessiveHalving samples n_candidates parameter sets, scores
+them on a subsample of each fold's training rows, keeps the best 1/factor
+and repeats with factor times the rows, so only a few candidates are ever
+fit on the full folds:
+
+    search = SuccessiveHalving('xgb', xgb_space, n_jobs=4)
+    search.fit(x_train, y_train, x_val, y_val)
+    search.best_params_, search.results_
+
+XGBoost stops adding trees when logloss on x_val stops improving (native
+early stopping), SVC is only fit on the subsampled rows (max_resources caps
+them). Each (candidate, fold, rows) score is written to cache_dir as it
+finishes, so an interrupted search picks up where it stopped. Folds run in
+n_jobs joblib processes, each with cpu_count // n_jobs threads for XGBoost
+and BLAS, so the two don't oversubscribe the cores.
+
+    python tuning.py xgb --n_jobs 4
+'''
+import argparse
+import hashlib
+import json
+import math
+import os
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import loguniform, uniform
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterSampler, StratifiedKFold
+from threadpoolctl import threadpool_limits
+
+from dataset_store import DatasetStore
+
+xgb_space = {
+    'max_depth': [1, 3, 5, 7, 9],
+    'learning_rate': loguniform(.01, .3),
+    'subsample': uniform(.5, .5),
+    'colsample_bytree': uniform(.5, .5),
+    'min_child_weight': [1, 5, 10],
+    'gamma': [0, 1, 5],
+}
+
+svc_space = {
+    'C': loguniform(1e-4, 1e2),
+    'gamma': loguniform(1e-4, 1),
+    'kernel': ['rbf', 'linear'],
+}
+
+def make_model(model, params, nthread=1, early_stopping=False):
+    if model == 'xgb':
+        from xgboost import XGBClassifier
+        return XGBClassifier(n_estimators=1000, random_state=1234,
+                             n_jobs=nthread, eval_metric='logloss',
+                             early_stopping_rounds=(20 if early_stopping
+                                                    else None),
+                             **params)
+    if model == 'svc':
+        from sklearn.svm import SVC
+        return SVC(random_state=1234, **params)
+    raise ValueError('unknown model ' + model)
+
+def _jsonable(params):
+    # Sampled values are numpy scalars
+    return {k: v.item() if isinstance(v, np.generic) else v
+            for k, v in params.items()}
+
+def data_key(X, y):
+    '''sha256 of the training data, so cached scores are only reused for
+    the same x_train/y_train'''
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(X).tobytes())
+    sha.update(np.ascontiguousarray(y).tobytes())
+    return sha.hexdigest()
+
+class FoldCache(object):
+    '''One json file per (model, params, fold, rows, data) score'''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode())
+        return os.path.join(self.path, digest.hexdigest() + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, result):
+        # Written whole and renamed, so a killed worker leaves no partial file
+        tmp = self._file(key) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp, self._file(key))
+
+def fit_fold(model, params, X, y, train, test, x_val, y_val, scoring,
+             nthread, cache, key):
+    '''Fits params on rows train and scores them on rows test. Returns the
+    cached result if there is one.'''
+    result = cache.get(key)
+    if result is not None:
+        return result
+    early_stopping = model == 'xgb' and x_val is not None
+    estimator = make_model(model, params, nthread, early_stopping)
+    with threadpool_limits(nthread):
+        if early_stopping:
+            estimator.fit(X[train], y[train], eval_set=[(x_val, y_val)],
+                          verbose=False)
+        else:
+            estimator.fit(X[train], y[train])
+        score = get_scorer(scoring)(estimator, X[test], y[test])
+    result = {'score': float(score)}
+    if early_stopping:
+        result['best_iteration'] = int(estimator.best_iteration)
+    cache.put(key, result)
+    return result
+
+class SuccessiveHalving(object):
+    '''Successive halving over n_candidates samples of space (dict of lists
+    or scipy distributions). Rows per fold grow from min_resources by factor
+    each round up to max_resources (default all of the fold).'''
+    def __init__(self, model, space, n_candidates=27, factor=3,
+                 min_resources=None, max_resources=None, n_splits=3,
+                 scoring='roc_auc', n_jobs=1, cache_dir='tuning_cache',
+                 random_state=1234):
+        self.model = model
+        self.space = space
+        self.n_candidates = n_candidates
+        self.factor = factor
+        self.min_resources = min_resources
+        self.max_resources = max_resources
+        self.n_splits = n_splits
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.random_state = random_state
+
+    def _schedule(self, fold_rows):
+        '''Rows per fold for each round. There are ceil(log_factor(
+        n_candidates)) rounds, so the last one compares the final (two or
+        more) candidates on max_resources rows, as in sklearn's
+        HalvingRandomSearchCV.'''
+        n_rounds = 1
+        while self.factor**n_rounds < self.n_candidates:
+            n_rounds += 1
+        max_resources = min(self.max_resources or fold_rows, fold_rows)
+        min_resources = self.min_resources or max(
+            max_resources // self.factor**(n_rounds - 1), 2*self.n_splits)
+        return [min(min_resources*self.factor**i, max_resources)
+                for i in range(n_rounds - 1)] + [max_resources]
+
+    def fit(self, X, y, x_val=None, y_val=None):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y)
+        if x_val is not None:
+            x_val = np.asarray(x_val, dtype=float)
+            y_val = np.asarray(y_val)
+        n_jobs = os.cpu_count() if self.n_jobs < 0 else self.n_jobs
+        nthread = max(1, (os.cpu_count() or 1) // n_jobs)
+        cache = FoldCache(self.cache_dir)
+        data = data_key(X, y)
+        if x_val is not None:
+            data += data_key(x_val, y_val)
+
+        folds = list(StratifiedKFold(self.n_splits, shuffle=True,
+                                     random_state=self.random_state)
+                     .split(X, y))
+        # Each round's rows are the first n of a fixed shuffle of the fold,
+        # so rounds (and resumed runs) see nested subsamples
+        rng = np.random.RandomState(self.random_state)
+        folds = [(rng.permutation(train), test) for train, test in folds]
+        candidates = [_jsonable(i) for i in ParameterSampler(
+            self.space, self.n_candidates, random_state=self.random_state)]
+
+        results = []
+        alive = list(range(len(candidates)))
+        for round_, rows in enumerate(self._schedule(min(
+                len(train) for train, _ in folds))):
+            tasks = [(i, k) for i in alive for k in range(len(folds))]
+            scores = Parallel(n_jobs=n_jobs)(
+                delayed(fit_fold)(
+                    self.model, candidates[i], X, y,
+                    np.sort(folds[k][0][:rows]), folds[k][1], x_val, y_val,
+                    self.scoring, nthread, cache,
+                    {'model': self.model, 'params': candidates[i],
+                     'fold': k, 'n_splits': self.n_splits, 'rows': rows,
+                     'scoring': self.scoring, 'seed': self.random_state,
+                     'data': data})
+                for i, k in tasks)
+            for i in alive:
+                fold_scores = [s for (j, _), s in zip(tasks, scores) if j == i]
+                results.append({
+                    'round': round_,
+                    'rows': rows,
+                    'candidate': i,
+                    'params': candidates[i],
+                    'mean_score': np.mean([s['score'] for s in fold_scores]),
+                    'std_score': np.std([s['score'] for s in fold_scores]),
+                    'best_iteration': (
+                        int(np.median([s['best_iteration']
+                                       for s in fold_scores]))
+                        if 'best_iteration' in fold_scores[0] else None),
+                })
+            round_results = sorted(results[-len(alive):],
+                                   key=lambda r: -r['mean_score'])
+            if len(alive) == 1:
+                break
+            alive = [r['candidate'] for r in round_results[
+                :int(math.ceil(len(alive) / self.factor))]]
+
+        self.results_ = pd.DataFrame(results)
+        best = round_results[0]
+        self.best_params_ = dict(best['params'])
+        if best['best_iteration'] is not None:
+            # Trees to refit without x_val
+            self.best_params_['n_estimators'] = best['best_iteration'] + 1
+        self.best_score_ = best['mean_score']
+        return self
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Tune the BP classifiers on the stored x/y splits')
+    parser.add_argument('model', choices=['xgb', 'svc'])
+    parser.add_argument('--store', default='data_store')
+    parser.add_argument('--n_candidates', type=int, default=27)
+    parser.add_argument('--factor', type=int, default=3)
+    parser.add_argument('--max_resources', type=int,
+                        help='rows per fold in the last round (default all '
+                        'for xgb, 20000 for svc)')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='folds fit at once (-1 for all cores)')
+    parser.add_argument('--cache_dir', default='tuning_cache')
+    args = parser.parse_args()
+    store = DatasetStore(args.store)
+    max_resources = args.max_resources
+    if max_resources is None and args.model == 'svc':
+        max_resources = 20000
+    search = SuccessiveHalving(
+        args.model, xgb_space if args.model == 'xgb' else svc_space,
+        args.n_candidates, args.factor, max_resources=max_resources,
+        n_jobs=args.n_jobs, cache_dir=args.cache_dir)
+    search.fit(store.read('x_train'), store.read('y_train'),
+               store.read('x_val'), store.read('y_val'))
+    store.write_meta('tuning_' + args.model,
+                     {'best_params': search.best_params_,
+                      'best_score': search.best_score_})
+    print(search.results_.groupby('round')[['rows', 'mean_score']].max())
+    print(search.best_params_, search.best_score_)
@@ -0,0 +1,74 @@
+'''Throughput/latency benchmark for serve_predictions.py.
+
+Sends the patients in a raw long-format csv to a running server in
+micro-batches and reports latency percentiles and patients/second:
+    python bench_server.py --input test_data.csv --batch 1 --concurrency 4
+'''
+import argparse
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+import numpy as np
+import pandas as pd
+
+def post_predict(url, raw_df):
+    '''Scores a raw long-format df on the server, returns list of
+    {'PATIENT_ID', 'Prediction'} dicts'''
+    body = raw_df.to_csv(index=False).encode('utf-8')
+    request = Request(url.rstrip('/') + '/predict', data=body,
+                      headers={'Content-Type': 'text/csv'})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))['predictions']
+
+def make_batches(raw_df, batch_size):
+    '''Splits raw df into bodies of batch_size whole patients'''
+    ids = raw_df.PATIENT_ID.unique()
+    groups = raw_df.groupby('PATIENT_ID', sort=False)
+    return [pd.concat([groups.get_group(i) for i in ids[j:j+batch_size]])
+            for j in range(0, len(ids), batch_size)]
+
+def run_benchmark(url, raw_df, batch_size=1, concurrency=1, n_batches=None):
+    batches = make_batches(raw_df, batch_size)[:n_batches]
+
+    def timed(batch):
+        start = time.time()
+        post_predict(url, batch)
+        return time.time() - start
+
+    # Warm-up request so first-call costs are not counted
+    post_predict(url, batches[0])
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(timed, batches)))
+    elapsed = time.time() - start
+    n_patients = sum(i.PATIENT_ID.nunique() for i in batches)
+    return {
+        'batch_size': batch_size,
+        'concurrency': concurrency,
+        'requests': len(batches),
+        'patients': n_patients,
+        'patients_per_sec': n_patients/elapsed,
+        'latency_p50_ms': 1000*np.percentile(latencies, 50),
+        'latency_p95_ms': 1000*np.percentile(latencies, 95),
+        'latency_max_ms': 1000*latencies.max(),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark a running serve_predictions.py server')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--input', default='test_data.csv')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 10, 100],
+                        help='patients per request (one run per value)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--n_batches', type=int, default=None,
+                        help='limit requests per run')
+    args = parser.parse_args()
+
+    raw_df = pd.read_csv(args.input)
+    results = [run_benchmark(args.url, raw_df, batch_size=b,
+                             concurrency=args.concurrency,
+                             n_batches=args.n_batches)
+               for b in args.batch]
+    print(pd.DataFrame(results).to_string(index=False))
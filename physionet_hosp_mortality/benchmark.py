@@ -0,0 +1,264 @@
+'''Benchmark suite for the feature pipeline in get_predictions.py.
+
+Generates synthetic long-format data shaped like the challenge files
+(PATIENT_ID, Time, Parameter, Value; static vars at '00:00' and time vars
+over a 48 hour stay) and runs the pipeline transformers at several scaling
+points under profile_stages, reporting per stage wall time, rows/sec and
+traced memory, and per point peak RSS (each point runs in its own process):
+
+    python benchmark.py --patients 100 1000 4000 --obs 80
+
+The scaler, imputer and XGBoost model are fit on a separate synthetic
+training set (--train_patients), so no model files are needed. --memory
+adds a report comparing the default and low_memory transformer modes.
+'''
+import argparse
+import copy
+import multiprocessing
+import os
+import resource
+import sys
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from get_predictions import (keep_vars, static_vars, drop_vars, seq_vars,
+                             stay_dense, stay_sparse, stay_sparse_dict,
+                             get_time,
+                             get_static, parse_hours, collapse_time,
+                             OneHotImpute, MakeStatic, MakeSeq, densify,
+                             profile_stages, run_stage)
+
+onehot_vars = ['ICUType'] + [i+'_cats' for i in stay_sparse]
+
+def make_synthetic(n_patients, obs_per_patient=80, seed=1234,
+                   missing_rate=.02):
+    '''Returns raw long-format df for n_patients with on average
+    obs_per_patient time var observations each (rows grouped by patient,
+    sorted by Time). About missing_rate of values are -1.'''
+    rng = np.random.RandomState(seed)
+    ids = 132539 + np.arange(n_patients)
+
+    # Static records at admission
+    static = pd.DataFrame({
+        'PATIENT_ID': np.repeat(ids, len(static_vars) + 1),
+        'Time': '00:00',
+        'Parameter': np.tile(static_vars + ['Weight'], n_patients),
+        'Value': np.column_stack([
+            ids,
+            rng.randint(18, 90, n_patients),
+            rng.randint(0, 2, n_patients),
+            rng.normal(170, 10, n_patients).round(1),
+            rng.randint(1, 5, n_patients),
+            rng.normal(80, 15, n_patients).round(1),
+        ]).ravel(),
+    })
+
+    # Time vars, denser for vitals than labs
+    params = np.array(keep_vars + drop_vars)
+    weights = np.where(np.isin(params, seq_vars + stay_dense), 5., 1.)
+    n_obs = rng.poisson(obs_per_patient, n_patients) + 1
+    minutes = rng.randint(1, 48*60 + 1, n_obs.sum())
+    timed = pd.DataFrame({
+        'PATIENT_ID': np.repeat(ids, n_obs),
+        'Minutes': minutes,
+        'Parameter': rng.choice(params, n_obs.sum(), p=weights/weights.sum()),
+        'Value': rng.gamma(4, 20, n_obs.sum()).round(1),
+    })
+    # Spread sparse labs across their normal ranges so every abnormal
+    # category shows up
+    ranges = {var: [.5*lower, 1.5*upper] for var, (lower, upper)
+              in stay_sparse_dict.items() if np.isfinite([lower, upper]).all()}
+    ranges.update({'FiO2': [.21, 1], 'Lactate': [.5, 4], 'PaO2': [50, 300]})
+    for var, (lower, upper) in ranges.items():
+        mask = np.array(timed.Parameter == var)
+        timed.loc[mask, 'Value'] = rng.uniform(lower, upper,
+                                               mask.sum()).round(2)
+    # Blood gases record FiO2 alongside each PaO2
+    fio2 = timed.loc[timed.Parameter == 'PaO2'].copy()
+    fio2['Parameter'] = 'FiO2'
+    fio2['Value'] = rng.uniform(.21, 1, len(fio2)).round(2)
+    timed = pd.concat([timed, fio2])
+    timed.loc[rng.rand(len(timed)) < missing_rate, 'Value'] = -1
+    timed = timed.sort_values(['PATIENT_ID', 'Minutes'], kind='mergesort')
+    timed['Time'] = ['%02d:%02d' % (i // 60, i % 60) for i in timed.Minutes]
+
+    raw_df = pd.concat([static, timed.drop('Minutes', axis=1)])
+    raw_df = raw_df.sort_values(['PATIENT_ID', 'Time'], kind='mergesort')
+    return raw_df[['PATIENT_ID', 'Time', 'Parameter', 'Value']].reset_index(
+        drop=True)
+
+def peak_rss_mb():
+    '''Peak resident set size of this process so far, in MB'''
+    # On Linux ru_maxrss keeps the parent's peak across fork/exec, so a
+    # spawned benchmark process would report the parent's fitting run.
+    # VmHWM is this process's own.
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak/1024**2 if sys.platform == 'darwin' else peak/1024
+
+def fit_models(raw_df):
+    '''Fits q99_dict, mean_seq, OneHotImpute, the scaler and an XGBoost
+    model on raw_df. Returns dict of them.'''
+    X_time = get_time(raw_df, keep_vars).replace(-1, np.nan)
+    X_static = get_static(raw_df, static_vars).replace(-1, np.nan)
+    q99_dict = dict(X_time[keep_vars].quantile(.99))
+    q99_dict.update(dict(X_static.quantile(.99)))
+    X_seq = get_time(raw_df, seq_vars)
+    X_seq['Hours'] = parse_hours(X_seq.Time)
+    X_seq = collapse_time(X_seq, seq_vars, 4)
+    models = {
+        'q99_dict': q99_dict,
+        'mean_seq': X_seq.groupby('Time_4_hours')[
+            [i+'_mean' for i in seq_vars]].mean(),
+    }
+    X_merge = MakeStatic(q99_dict=q99_dict).transform(raw_df)
+    models['onehot_impute'] = OneHotImpute(onehot_vars).fit(X_merge)
+    X_prep = models['onehot_impute'].transform(X_merge)
+    models['std_scale'] = StandardScaler().fit(X_prep)
+    from xgboost import XGBClassifier
+    y = np.random.RandomState(0).randint(0, 2, len(X_prep))
+    models['xgb_model'] = XGBClassifier(gamma=1, max_depth=5,
+                                        n_estimators=50).fit(
+        models['std_scale'].transform(X_prep), y)
+    return models
+
+def run_stages(raw_df, models, trace_memory=False):
+    '''Runs MakeStatic, MakeSeq, OneHotImpute, scaling and prediction on
+    raw_df under profile_stages. Returns its report (one row per stage).'''
+    make_static = MakeStatic(q99_dict=models['q99_dict'])
+    make_seq = MakeSeq(seq_vars, 4, models['mean_seq'])
+    with profile_stages(trace_memory) as profiler:
+        X_merge = make_static.transform(raw_df)
+        make_seq.transform(raw_df)
+        X_prep = models['onehot_impute'].transform(X_merge)
+        X_std = run_stage('scaling', models['std_scale'].transform, X_prep)
+        run_stage('prediction', models['xgb_model'].predict, X_std)
+    return profiler.report()
+
+def run_point(n_patients, obs, seed, models, memory=False):
+    '''Benchmarks one scaling point. Run in a fresh process (see
+    benchmark_point) so peak RSS is this point's own. Returns (stage
+    results, point result, memory_report results).'''
+    raw_df = make_synthetic(n_patients, obs, seed=seed)
+    baseline = peak_rss_mb()
+    # Timed without tracemalloc (it slows numpy-heavy stages), then traced
+    # for per-stage memory
+    timing = run_stages(raw_df, models)
+    peak = peak_rss_mb()
+    traced = run_stages(raw_df, models, trace_memory=True)
+    stages = pd.DataFrame({
+        'patients': n_patients,
+        'stage': timing.stage,
+        'rows_in': timing.rows_in,
+        'seconds': timing.seconds,
+        'rows_per_sec': timing.rows_in/timing.seconds,
+        'mem_delta_mb': traced.mem_delta_mb.to_numpy(),
+        'mem_peak_mb': traced.mem_peak_mb.to_numpy(),
+    })
+    point = {
+        'patients': n_patients,
+        'rows': len(raw_df),
+        'seconds': timing.seconds.sum(),
+        'baseline_rss_mb': baseline,
+        'peak_rss_mb': peak,
+        'pipeline_rss_mb': peak - baseline,
+    }
+    memory_results = memory_report(raw_df, models) if memory else []
+    return stages.to_dict('records'), point, memory_results
+
+def benchmark_point(n_patients, obs, seed, models, memory=False):
+    '''run_point in a new (spawned, not forked) process'''
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_point, n_patients, obs, seed, models,
+                           memory).result()
+
+def frame_mb(obj):
+    '''Deep memory of a df (0 for anything else), in MB'''
+    if isinstance(obj, pd.DataFrame):
+        return obj.memory_usage(deep=True).sum()/1024**2
+    return 0.
+
+def memory_report(raw_df, models):
+    '''Runs MakeStatic and OneHotImpute in default and low_memory mode and
+    compares peak traced memory, output size, memory left on the
+    transformers and predictions'''
+    results = []
+    preds = {}
+    for low_memory in [False, True]:
+        make_static = MakeStatic(q99_dict=models['q99_dict'],
+                                 low_memory=low_memory)
+        onehot_impute = copy.copy(models['onehot_impute'])
+        onehot_impute.low_memory = low_memory
+        tracemalloc.start()
+        X_merge = make_static.transform(raw_df)
+        X_prep = onehot_impute.transform(X_merge)
+        peak = tracemalloc.get_traced_memory()[1]/1024**2
+        tracemalloc.stop()
+        X_std = models['std_scale'].transform(densify(X_prep))
+        preds[low_memory] = models['xgb_model'].predict(X_std)
+        results.append({
+            'patients': raw_df.PATIENT_ID.nunique(),
+            'low_memory': low_memory,
+            'peak_traced_mb': peak,
+            'static_out_mb': frame_mb(X_merge),
+            'onehot_out_mb': frame_mb(X_prep),
+            'retained_mb': sum(frame_mb(i) for step in
+                               [make_static, onehot_impute]
+                               for i in vars(step).values()),
+            'pred_agreement': (preds[low_memory] == preds[False]).mean(),
+        })
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the physionet feature pipeline')
+    parser.add_argument('--patients', type=int, nargs='+',
+                        default=[100, 1000, 4000],
+                        help='scaling points (number of patients)')
+    parser.add_argument('--obs', type=int, default=80,
+                        help='mean time var observations per patient')
+    parser.add_argument('--train_patients', type=int, default=2000,
+                        help='patients in the synthetic set the models '
+                        'are fit on')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--csv', default=None,
+                        help='also write results to this csv')
+    parser.add_argument('--memory', action='store_true',
+                        help='also compare default and low_memory modes')
+    args = parser.parse_args()
+
+    # Fit q99_dict, mean_seq, imputer, scaler and model once
+    models = fit_models(make_synthetic(args.train_patients, args.obs,
+                                       seed=args.seed + 1))
+    results = []
+    points = []
+    memory_results = []
+    for n_patients in args.patients:
+        stage_results, point, point_memory = benchmark_point(
+            n_patients, args.obs, args.seed, models, args.memory)
+        results.extend(stage_results)
+        points.append(point)
+        memory_results.extend(point_memory)
+
+    results = pd.DataFrame(results)
+    print(results.pivot(index='stage', columns='patients',
+                        values='seconds').loc[results.stage.unique()]
+          .round(4).to_string())
+    print()
+    print(results.round(4).to_string(index=False))
+    print()
+    print(pd.DataFrame(points).round(3).to_string(index=False))
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+    if args.memory:
+        print()
+        print(pd.DataFrame(memory_results).round(3).to_string(index=False))
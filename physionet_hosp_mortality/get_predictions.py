@@ -1,13 +1,35 @@
+import json
+import logging
+import os
 import pickle
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.impute import SimpleImputer
 
-q99_dict = pickle.load(open('q99_dict.pickle', 'rb'))
+# q99_dict and mean_seq are loaded on first use (see load_default)
+default_artifacts = {}
+
+def load_default(name):
+    '''Returns default 'q99_dict' or 'mean_seq', loaded on first use from
+    the model bundle in the working directory or else from the pickle'''
+    if name not in default_artifacts:
+        if os.path.exists(os.path.join('model_bundle', 'manifest.json')):
+            from model_bundle import ModelBundle
+            default_artifacts[name] = getattr(ModelBundle('model_bundle'),
+                                              name)
+        else:
+            default_artifacts[name] = pickle.load(open(name + '.pickle',
+                                                       'rb'))
+    return default_artifacts[name]
 
 drop_vars = ['Cholesterol', 'RespRate', 
                  'TroponinI', 'TroponinT', 
@@ -44,15 +66,35 @@ stay_sparse_dict = {
 
 # Functions
 def get_time(X, time_vars, agg_method=min):
-    '''Returns long df from raw df'''
-    time_df = X.loc[np.array([True if i in time_vars else False \
-                              for i in X.Parameter])]
-    pivot_df = time_df.set_index(['PATIENT_ID', 'Time'], 
-                                 append=True).pivot(columns='Parameter')
-    groupby_df = pivot_df.groupby(['PATIENT_ID', 'Time']).agg(agg_method)
-    groupby_df.columns = groupby_df.columns.get_level_values(1)
+    '''Returns long df from raw df: one row per PATIENT_ID/Time with a
+    column for each time var. Duplicate obs are reduced with agg_method
+    (a function or groupby reduction name, e.g. 'mean').'''
+    time_df = X.loc[X.Parameter.isin(time_vars),
+                    ['PATIENT_ID', 'Time', 'Parameter', 'Value']]
+    # Integer codes for Parameter keep the grouping key small
+    codes, params = pd.factorize(time_df.Parameter, sort=True)
+    agg_method = {min: 'min', max: 'max'}.get(agg_method, agg_method)
+    groupby_df = time_df['Value'].groupby(
+        [time_df.PATIENT_ID, time_df.Time, codes]).agg(agg_method).unstack()
+    groupby_df.columns = params[groupby_df.columns]
+    # Keep a column for every time var, even if a batch never records it
+    groupby_df = groupby_df.reindex(
+        columns=pd.Index(sorted(time_vars), name='Parameter'))
     return groupby_df.reset_index()
 
+# Parsed 'HH:MM' -> hours, shared by every transformer in the pipeline
+time_cache = {}
+
+def parse_hours(times):
+    '''Returns array of hours for an array of 'HH:MM' strings. Each distinct
+    string is parsed once and cached, so repeat calls only do a lookup.'''
+    codes, uniques = pd.factorize(np.asarray(times, dtype=object))
+    new_times = [i for i in uniques if i not in time_cache]
+    if new_times:
+        hh_mm = pd.Series(new_times).str.split(':', expand=True).astype(float)
+        time_cache.update(zip(new_times, hh_mm[0] + hh_mm[1]/60))
+    return np.array([time_cache[i] for i in uniques])[codes]
+
 # Extract static variables:
 def get_static(X, static_vars):
     '''Parameters:
@@ -60,127 +102,156 @@ def get_static(X, static_vars):
     Returns: Static variables ['PATIENT_ID' 'RecordID' 'Age' 'Gender' 'Height' 
     'ICUType' 'Weight'] in wide format (i.e. PATIENT_ID is row index)'''
     
-    keep_obs = np.array([True if i in static_vars else False \
-                           for i in X.Parameter])
-    outdf = X.loc[keep_obs & np.array(X.Time=='00:00'),
+    # Only the admission ('00:00') record of each static var is used
+    keep_obs = X.Parameter.isin(static_vars) & (X.Time=='00:00')
+    outdf = X.loc[keep_obs,
                   ['PATIENT_ID', 'Parameter', 'Value']]
-    return outdf.pivot(index='PATIENT_ID', columns='Parameter', values='Value')
+    outdf = outdf.pivot(index='PATIENT_ID', columns='Parameter', values='Value')
+    return outdf.reindex(columns=pd.Index(sorted(static_vars),
+                                          name='Parameter'))
+
+def time_bins(values, interval, unit='hour'):
+    '''Vectorized interval assignment (closed right). Values equal to 0 are
+    assigned to the lowest interval, values outside the 48 hour stay get
+    index -1 and a nan ceiling.
+
+    values: array-like of times
+    interval: bin width
+    unit: time, 'hour', or 'minute'
+    Returns: (bin ceilings, bin indices, list of all bin ceilings)
+    '''
+    if unit=='hour':
+        max_time = int(48/interval)
+    elif unit=='minute':
+        max_time = int(48*60/interval)
+    else:
+        raise ValueError('bad unit specification')
+
+    bins = [i*interval for i in range(1,max_time+1)]
+    bin_array = np.array(bins)
+    values = np.asarray(values, dtype=float)
+
+    # First ceiling >= value gives the closed-right bin; 0 lands in bin 0
+    idx = np.searchsorted(bin_array, values, side='left')
+    out_of_range = (values < 0) | (idx == len(bins)) | np.isnan(values)
+    idx[out_of_range] = -1
+    if out_of_range.any():
+        ceilings = np.where(out_of_range, np.nan,
+                            bin_array[np.clip(idx, 0, None)])
+    else:
+        ceilings = bin_array[idx]
+    return ceilings, idx, bins
 
 def assign_interval(l, interval, unit, return_int_len=False,
                    return_all_bins=False):
     '''Returns ceiling value of interval (closed right).
-    If value==0, assigned to lowest interval
+    If value==0, assigned to lowest interval. Values outside the stay
+    are dropped.
     
     l: list to get interval bin assignments for
     interval: bin width
     unit: time, 'hour', or 'minute'
     return_int_len: return total length of all bins?
     '''
-    if unit=='hour':
-        max_time = int(48/interval)
-    elif unit=='minute':
-        max_time = int(48*60/interval)
-    else:
+    try:
+        _, idx, bins = time_bins(l, interval, unit)
+    except ValueError:
         return 'bad unit specification'
-    
-    int_floors = [i*interval for i in range(0,max_time)]
-    int_ceilings = [i*interval for i in range(1,max_time+1)]
-    
-    out_l = []
-    for obs in l:
-        get_interval=True
-        for i in range(len(int_ceilings)):
-            if get_interval & (obs==0):
-                out_l.append(interval)
-                get_interval=False
-            if get_interval & (int_floors[i] < obs <= int_ceilings[i]):
-                out_l.append(int_ceilings[i])
-                get_interval=False   
+
+    out_l = np.array(bins)[idx[idx >= 0]].tolist()
     if return_int_len:
-        return out_l, len(int_ceilings)
+        return out_l, len(bins)
     if return_all_bins:
-        return out_l, int_ceilings
+        return out_l, bins
     else:
         return out_l
 
-def summary_extract(x):
-    '''use with lambda to get summary stats'''
-    x_min = x.min()
-    x_max = x.max()
-    x_med = x.median()
-    nan_strip = [i for i in x if str(i) != 'nan']
-    if len(nan_strip) > 0:
-        x_first = nan_strip[0]
-    else:
-        x_first = np.nan
-    if len(nan_strip) > 0:
-        x_last = nan_strip[len(nan_strip)-1]
-    else:
-        x_last = np.nan
-    x_n = len(nan_strip)
-    return [x_min, x_max, x_med, x_first, x_last, x_n]
+summary_stats = ['min', 'max', 'med', 'first', 'last', 'n']
+
+def grouped_summary(df, varlist, bin_idx=None, n_bins=1,
+                    group_var='PATIENT_ID'):
+    '''min, max, median, first/last non-missing value and n for every var
+    in varlist per patient (and per bin if bin_idx is given), computed with
+    built-in groupby reductions.
+    
+    bin_idx: array of bin positions (0 to n_bins-1, -1 to skip row)
+    Returns: (patient ids, float array of shape
+    (patients, len(varlist)*n_bins*len(summary_stats))) ordered by var,
+    then bin, then stat. Bins without obs get nan stats and n of 0.
+    '''
+    patients = pd.Index(df[group_var].unique()).sort_values()
+    if bin_idx is None:
+        bin_idx = np.zeros(len(df), dtype=int)
+    keep = np.asarray(bin_idx) >= 0
+    values = df.loc[keep, varlist]
+    gb = values.groupby([df.loc[keep, group_var].to_numpy(),
+                         np.asarray(bin_idx)[keep]], sort=False)
+    
+    out = np.full((len(patients), n_bins, len(summary_stats), len(varlist)),
+                  np.nan)
+    out[:, :, summary_stats.index('n'), :] = 0
+    for s, stat_df in enumerate([gb.min(), gb.max(), gb.median(),
+                                 gb.first(), gb.last(), gb.count()]):
+        rows = patients.get_indexer(stat_df.index.get_level_values(0))
+        bins = stat_df.index.get_level_values(1)
+        out[rows, bins, s, :] = stat_df.to_numpy(dtype=float)
+    
+    out = out.transpose(0, 3, 1, 2).reshape(len(patients), -1)
+    return patients, out
 
 def stay_dense_extract(df, varlist):
     '''for getting summary stats for entire stay vars'''
-    extract_df = df.groupby('PATIENT_ID')[varlist].agg(
-        lambda x: summary_extract(x))
-    outdf = pd.DataFrame()
-    for var in extract_df.columns:
-        colnames = [var+'_'+i for i in ['min', 'max', 'med', 
-                                        'first', 'last', 'n']]
-        
-        loop_df = pd.DataFrame([np.array(i) for i in extract_df[var]],
-                                columns=colnames)
-        outdf = pd.concat([outdf, loop_df], axis=1)
-    return outdf
+    _, stats = grouped_summary(df, varlist)
+    colnames = [var+'_'+i for var in varlist for i in summary_stats]
+    return pd.DataFrame(stats, columns=colnames)
 
 def day_var_extract(df, varlist):
     '''returns summary stats for each 24 hour period of stay'''
-    # Deal with patients with no obs after 24hrs
-    bad_mask = df.groupby('PATIENT_ID')['Hours'].max()<=24
-    bad_ids = bad_mask[bad_mask].index
-    filler_df = pd.DataFrame({
-        'PATIENT_ID': bad_ids,
-        'Hours': [47.9 for i in range(len(bad_ids))]
-                             })
-    df = pd.merge(df, filler_df, on=['PATIENT_ID', 'Hours'], how='outer')
-    df.sort_values(by=['PATIENT_ID', 'Hours'], inplace=True)
+    # first/last follow time order within patient
+    df = df.sort_values(by=['PATIENT_ID', 'Hours'], kind='mergesort')
+    _, bin_idx, bins = time_bins(df['Hours'], 24, 'hour')
+    # Patients with no obs after 24hrs get nan/0 for the 48hr bin
+    _, stats = grouped_summary(df, varlist, bin_idx=bin_idx,
+                               n_bins=len(bins))
+    colnames = [var+'_'+i+'_'+str(b) for var in varlist for b in bins
+                for i in summary_stats]
+    return pd.DataFrame(stats, columns=colnames)
     
-    gb_time = assign_interval(df['Hours'], 24, 'hour')
-    extract_df = df.groupby(['PATIENT_ID', gb_time])[varlist].agg(
-        lambda x: summary_extract(x))
-    outdf = pd.DataFrame()
-    for var in extract_df.columns:
-        colnames = [var+'_'+i for i in ['min_24', 'max_24', 'med_24', 
-                                        'first_24', 'last_24', 'n_24',
-                                       'min_48', 'max_48', 'med_48', 
-                                        'first_48', 'last_48', 'n_48']]
-        
-        loop_df = pd.DataFrame(
-            np.array([np.array(i) for i in extract_df[var]]).reshape(-1,12),
-            columns=colnames
-        )
-        outdf = pd.concat([outdf, loop_df], axis=1)
-    return outdf  
+def grouped_slopes(df, varlist, time_var='Hours', group_var='PATIENT_ID'):
+    '''Closed-form OLS slope of each var on time_var for every group in
+    one pass. Groups are returned in order of appearance; groups with
+    fewer than 2 non-missing obs for a var get nan.'''
+    groups, group_ids = pd.factorize(df[group_var])
+    n_groups = len(group_ids)
+    t = df[time_var].to_numpy(dtype=float)
+    y = df[varlist].to_numpy(dtype=float)
+    valid = ~np.isnan(y)
     
+    def group_sum(values):
+        out = np.empty((n_groups, values.shape[1]))
+        for j in range(values.shape[1]):
+            out[:, j] = np.bincount(groups, weights=values[:, j],
+                                    minlength=n_groups)
+        return out
+    
+    # Center within group/var so the slope is stable for long stays
+    x = np.where(valid, t[:, None], 0)
+    y = np.where(valid, y, 0)
+    n = group_sum(valid.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = group_sum(x)/n
+        y_mean = group_sum(y)/n
+        dx = np.where(valid, x - x_mean[groups], 0)
+        dy = np.where(valid, y - y_mean[groups], 0)
+        slopes = group_sum(dx*dy)/group_sum(dx*dx)
+    slopes[n <= 1] = np.nan
+    return pd.DataFrame(slopes, index=group_ids, columns=varlist)
+
 def extract_trends(df, varlist, time_var='Hours'):
-    '''returns linear trend across entire stay for specified vars.
-    this takes some time.'''
-    outlist = []
-    for var in varlist:
-        pat_vector = []
-        for patient in df.PATIENT_ID.unique():
-            x = df.loc[df.PATIENT_ID==patient,[time_var, var]].dropna()
-            A = np.vstack([x[time_var], np.ones(len(x))]).T
-            y = x[var].to_numpy()
-            m, c = np.linalg.lstsq(A, y, rcond=None)[0]
-            if len(y)>1: 
-                pat_vector.append(m)
-            else:
-                pat_vector.append(np.nan)
-        outlist.append(np.array(pat_vector))
-    return pd.DataFrame(np.array(outlist).T,
-                       columns=[i+'_trend' for i in varlist])
+    '''returns linear trend across entire stay for specified vars'''
+    trends = grouped_slopes(df, varlist, time_var=time_var)
+    trends.columns = [i+'_trend' for i in varlist]
+    return trends.reset_index(drop=True)
 
 def abnormal_cats(x, bounds):
     '''Returns 0 for missing, 1 for within normal, 2 for abnormal based
@@ -197,99 +268,262 @@ def abnormal_cats(x, bounds):
     else:
         return 2
 
+def bounds_table(cutoff_dict, varlist):
+    '''Returns arrays of lower and upper bounds for varlist
+
+    cutoff_dict
+        dict of var: [lower, upper] (e.g. stay_sparse_dict), or df indexed
+        by var with 'lower' and 'upper' columns'''
+    if isinstance(cutoff_dict, pd.DataFrame):
+        bounds = cutoff_dict.loc[varlist, ['lower', 'upper']]
+        bounds = bounds.to_numpy(dtype=float)
+    else:
+        bounds = np.array([cutoff_dict[var] for var in varlist], dtype=float)
+    return bounds[:, 0], bounds[:, 1]
+
+def abnormal_codes(values, lower, upper):
+    '''Vectorized abnormal_cats for a 2-D array of obs x vars with a lower
+    and upper bound per var. 0=nan, 1=normal, 2=abnormal'''
+    codes = np.where((values >= lower) & (values <= upper), 1, 2)
+    codes[np.isnan(values)] = 0
+    return codes
+
 def stay_sparse_extract(df, varlist, cutoff_dict):
     '''extract categorical features from sparse variables.
-    0=nan, 1=normal, 2=abnormal'''
-    new_features = []
-    for var in varlist:
-        loop_list = [abnormal_cats(i,stay_sparse_dict[var]) for i in df[var]]
-        loop_features = pd.Series(loop_list).groupby(df.PATIENT_ID).max()
-        new_features.append(np.array(loop_features))
-    features_df = pd.DataFrame(np.array(new_features).T, 
-                               columns=[i+'_cats' for i in varlist])
-    return features_df
+    0=nan, 1=normal, 2=abnormal. cutoff_dict is any bounds table accepted
+    by bounds_table'''
+    lower, upper = bounds_table(cutoff_dict, varlist)
+    codes = abnormal_codes(df[varlist].to_numpy(dtype=float), lower, upper)
+    features_df = pd.DataFrame(codes, columns=[i+'_cats' for i in varlist])
+    features_df = features_df.groupby(df.PATIENT_ID.to_numpy()).max()
+    return features_df.reset_index(drop=True)
+
+def seq_tensor(df, varlist, interval):
+    '''Bins each patient's stay into interval-hour bins.
+    Returns (PATIENT_IDs in order of appearance, list of bin ceilings,
+    means, ns) where means and ns are (patients x bins x vars) arrays of the
+    bin means and non-missing counts. Empty bins get the patient's mean of
+    bin means (nan if the patient has no values for a var).'''
+    _, bin_idx, bins = time_bins(df['Hours'], interval, 'hour')
+    p_codes, p_id = pd.factorize(df['PATIENT_ID'])
+    shape = (len(p_id), len(bins), len(varlist))
+    
+    # Grouped sums/counts over flat (patient, bin) cells
+    valid = bin_idx >= 0
+    cell = p_codes[valid]*len(bins) + bin_idx[valid]
+    values = df[varlist].to_numpy(dtype=float)[valid]
+    present = ~np.isnan(values)
+    sums = np.empty(shape)
+    ns = np.empty(shape)
+    for j in range(len(varlist)):
+        sums[:, :, j] = np.bincount(
+            cell, weights=np.where(present[:, j], values[:, j], 0),
+            minlength=shape[0]*shape[1]).reshape(shape[:2])
+        ns[:, :, j] = np.bincount(
+            cell, weights=present[:, j],
+            minlength=shape[0]*shape[1]).reshape(shape[:2])
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums/ns
+        # Replace missing bins with patient-level mean
+        has_mean = ns > 0
+        patient_mean = np.where(has_mean, means, 0).sum(axis=1) / \
+            has_mean.sum(axis=1)
+    means = np.where(has_mean, means, patient_mean[:, None, :])
+    return p_id, bins, means, ns
 
 def collapse_time(df, varlist, interval):
-    '''returns time_df as df with specified intervals for all ids'''
-    # Get intervals, bins
-    intervals, bins = assign_interval(df['Hours'], 4, 'hour',
-                                     return_all_bins=True)
-    # Start seq df
-    p_id = df['PATIENT_ID'].unique()
+    '''returns time_df as df with specified intervals for all ids (long
+    layout of seq_tensor: PATIENT_ID, bin, var_means..., var_ns...)'''
+    p_id, bins, means, ns = seq_tensor(df, varlist, interval)
     seq_label = 'Time_' + str(interval) + '_hours'
     seq_df = pd.DataFrame({
-        'PATIENT_ID': [i for j in \
-                       [[i]*len(bins) for i in p_id] \
-                      for i in j],
-        seq_label: [i for j in \
-                    [bins for i in p_id] \
-                   for i in j]
+        'PATIENT_ID': np.repeat(np.asarray(p_id), len(bins)),
+        seq_label: np.tile(bins, len(p_id))
     })
-    
-    # Add intervals to df
-    df[seq_label] = intervals
-    
-    # Mean Bins
-    mean_bins = df.groupby(['PATIENT_ID', 
-                            seq_label])[varlist].mean().reset_index()
-    new_column_names = [i for i in mean_bins.columns]
-    new_column_names[-3:] = [i + '_mean' for i in new_column_names[-3:]]
-    mean_bins.columns = new_column_names
-    
-    # N/Samples Bins
-    ns_bins = df.groupby(
-        ['PATIENT_ID', seq_label]
-    )[varlist].agg(lambda x: sum(x.isna()==False)).reset_index()
-    new_column_names = [i for i in ns_bins.columns]
-    new_column_names[-3:] = [i + '_ns' for i in new_column_names[-3:]]
-    ns_bins.columns = new_column_names
-    
-    # Finish seq_df
-    seq_df = pd.merge(seq_df, 
-                      mean_bins, 
-                      on=['PATIENT_ID', seq_label], 
-                      how='outer')
-    
-    seq_df = pd.merge(seq_df, 
-                      ns_bins, 
-                      on=['PATIENT_ID', seq_label], 
-                      how='outer')
-    
-    # Make np.nan 0:
-    seq_df.iloc[:,-3:] = seq_df.iloc[:,-3:].replace(np.nan, 0)
-    
-    # Replace missing bins with patient-level mean
-    imputed = seq_df.groupby('PATIENT_ID')[mean_bins.columns[2:]].transform(
-        lambda x: x.fillna(x.mean())
-    )
-    seq_df.loc[:,mean_bins.columns[2:]] = imputed
-    
+    for j, var in enumerate(varlist):
+        seq_df[var + '_mean'] = means[:, :, j].ravel()
+    for j, var in enumerate(varlist):
+        seq_df[var + '_ns'] = ns[:, :, j].ravel()
     return seq_df
 
 def seq_impute(df, varlist, seq_dict):
-    '''imputes empty sequences with specified means in seq_dict'''
+    '''imputes empty sequences with specified means in seq_dict, matched
+    on bin position within each patient'''
+    empty = df[varlist].isna().groupby(df.PATIENT_ID).transform('all')
+    bin_pos = df.groupby('PATIENT_ID').cumcount().to_numpy()
     for var in varlist:
-        for ids in df.loc[df[var].isna(),
-                          ['PATIENT_ID', var]].PATIENT_ID.unique():
-            df.loc[(df[var].isna()) & (df.PATIENT_ID==ids),
-                   var] = np.array(seq_dict[var])
+        mask = empty[var].to_numpy()
+        if mask.any():
+            df.loc[mask, var] = np.asarray(seq_dict[var])[bin_pos[mask]]
     return df
 
-# Load mean_seq
-mean_seq = pickle.load(open('mean_seq.pickle', 'rb'))
+def shard_patients(X, n_shards):
+    '''Splits raw df into up to n_shards dfs of whole patients, in
+    PATIENT_ID order'''
+    ids = np.sort(X.PATIENT_ID.unique())
+    return [X.loc[X.PATIENT_ID.isin(shard)] 
+            for shard in np.array_split(ids, n_shards) if len(shard)]
+
+def _transform_shard(estimator, X):
+    return estimator, estimator.transform(X)
+
+def sharded_transform(estimator, X, n_jobs):
+    '''Runs a copy of estimator (with n_jobs=1) on each patient shard of X
+    in a process pool. Returns (transformed copy, output) pairs in
+    PATIENT_ID order'''
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    shards = shard_patients(X, n_jobs)
+    copies = [clone(estimator).set_params(n_jobs=1) for i in shards]
+    with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        return list(pool.map(_transform_shard, copies, shards))
+
+# Low-memory mode
+code_vars = ['Gender', 'ICUType']
+
+def compact_features(X_merge, code_vars):
+    '''Downcasts float columns to float32 and code_vars/_cats columns to
+    int8 codes (left as float32 if they have missing values)'''
+    cat_cols = [i for i in X_merge.columns 
+                if i in code_vars or i.endswith('_cats')]
+    dtypes = {}
+    for col in X_merge.columns:
+        if col in cat_cols and X_merge[col].notna().all():
+            dtypes[col] = np.int8
+        elif X_merge[col].dtype.kind == 'f':
+            dtypes[col] = np.float32
+    return X_merge.astype(dtypes)
+
+def sparse_one_hot(oh, X):
+    '''Sparse (csr, float32) equivalent of a fitted OneHotEncoder's dense
+    transform of X, built without the dense intermediate'''
+    n_rows = len(X)
+    indices = np.empty((n_rows, len(oh.categories_)), dtype=np.int64)
+    offset = 0
+    for k, cats in enumerate(oh.categories_):
+        values = X.iloc[:, k].to_numpy(dtype=cats.dtype)
+        idx = np.searchsorted(cats, values).clip(0, len(cats) - 1)
+        found = (cats[idx] == values) | (pd.isna(cats[idx]) & 
+                                          pd.isna(values))
+        if not found.all():
+            raise ValueError('Found unknown categories %s in column %d '
+                             'during transform' % 
+                             (np.unique(values[~found]).tolist(), k))
+        indices[:, k] = idx + offset
+        offset += len(cats)
+    return sparse.csr_matrix(
+        (np.ones(indices.size, dtype=np.float32), indices.ravel(),
+         np.arange(0, indices.size + 1, indices.shape[1])),
+        shape=(n_rows, offset))
+
+def densify(X):
+    '''Converts sparse columns (low_memory one-hot output) back to dense'''
+    sparse_cols = {col: dtype.subtype for col, dtype in X.dtypes.items() 
+                   if isinstance(dtype, pd.SparseDtype)}
+    return X.astype(sparse_cols) if sparse_cols else X
+
+def set_low_memory(pipe, low_memory=True):
+    '''Switches low_memory on every pipeline step that supports it'''
+    for name, step in pipe.steps:
+        # By class name: loaded pipelines hold get_predictions classes even
+        # when this file runs as __main__, and older pickles lack the
+        # low_memory attribute
+        if type(step).__name__ in ('MakeStatic', 'OneHotImpute'):
+            step.low_memory = low_memory
+    return pipe
+
+# Opt-in stage profiling (see profile_stages)
+active_profiler = None
+
+class StageProfiler(object):
+    '''Collects one record per stage run inside the transformers: wall time,
+    traced memory delta/peak, input/output shapes. Use via profile_stages.'''
+    def __init__(self, trace_memory=True, logger=None):
+        self.trace_memory = trace_memory
+        self.logger = logger
+        self.records = []
+    
+    def run(self, stage, func, *args, **kwargs):
+        data = args[0] if args else None
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            mem_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        record = {
+            'stage': stage,
+            'seconds': time.perf_counter() - start,
+            'in_shape': getattr(data, 'shape', None),
+            'out_shape': getattr(out, 'shape', None),
+            'rows_in': len(data) if hasattr(data, '__len__') else None,
+            'rows_out': len(out) if hasattr(out, '__len__') else None,
+        }
+        if self.trace_memory:
+            mem_end, mem_peak = tracemalloc.get_traced_memory()
+            record['mem_delta_mb'] = (mem_end - mem_start)/1024**2
+            record['mem_peak_mb'] = mem_peak/1024**2
+        self.records.append(record)
+        if self.logger is not None:
+            self.logger.info(json.dumps(record, default=str))
+        return out
+    
+    def report(self):
+        '''Returns df with one row per recorded stage'''
+        return pd.DataFrame(self.records)
+
+@contextmanager
+def profile_stages(trace_memory=True, logger=None):
+    '''Profiles every helper called by MakeStatic, MakeSeq and OneHotImpute
+    inside the with block, e.g.
+    
+        with profile_stages() as profiler:
+            pipe.transform(raw_df)
+        profiler.report()
+    
+    trace_memory: record memory with tracemalloc (slows numpy-heavy stages)
+    logger: logging.Logger (or True for this module's logger) that gets each
+    record as json. With n_jobs > 1 each shard's stages run in worker
+    processes and only the sharded transform is recorded.'''
+    global active_profiler
+    if logger is True:
+        logger = logging.getLogger(__name__)
+    profiler = StageProfiler(trace_memory, logger)
+    previous = active_profiler
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    active_profiler = profiler
+    try:
+        yield profiler
+    finally:
+        active_profiler = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+def run_stage(stage, func, *args, **kwargs):
+    '''Calls func, recording it as stage when profiling is active'''
+    if active_profiler is None:
+        return func(*args, **kwargs)
+    return active_profiler.run(stage, func, *args, **kwargs)
 
 class MakeStatic(BaseEstimator, TransformerMixin):
-    '''returns fully transformed df with all calculated vars. this
-    takes some time.'''
+    '''returns fully transformed df with all calculated vars. n_jobs > 1
+    (or -1 for all cores) splits patients across a process pool.
+    low_memory returns float32 features with int8 codes for categoricals 
+    and keeps only PATIENT_IDs_ (not X_time, X_static, X_merge_).'''
     # Get dicts/lists
     def __init__(self, keep_vars=keep_vars, 
                  static_vars=static_vars, 
-                 q99_dict=q99_dict,
+                 q99_dict=None,
                  seq_vars=seq_vars, 
                  day_vars=day_vars, 
                  stay_dense=stay_dense, 
                  stay_sparse=stay_sparse,
-                 stay_sparse_dict=stay_sparse_dict):
+                 stay_sparse_dict=stay_sparse_dict,
+                 n_jobs=1,
+                 low_memory=False):
         self.keep_vars = keep_vars
         self.static_vars = static_vars
         self.q99_dict = q99_dict
@@ -298,88 +532,138 @@ class MakeStatic(BaseEstimator, TransformerMixin):
         self.stay_dense = stay_dense
         self.stay_sparse = stay_sparse
         self.stay_sparse_dict = stay_sparse_dict
+        self.n_jobs = n_jobs
+        self.low_memory = low_memory
     
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, y=None):
+        # Estimators pickled before n_jobs/low_memory existed run serially
+        # and keep their intermediates
+        low_memory = getattr(self, 'low_memory', False)
+        if low_memory:
+            for attr in ['X_time', 'X_static', 'X_merge_']:
+                self.__dict__.pop(attr, None)
+        
+        if getattr(self, 'n_jobs', 1) not in (0, 1):
+            shards = run_stage('MakeStatic.sharded_transform',
+                               sharded_transform, self, X, self.n_jobs)
+            self.PATIENT_IDs_ = shards[0][0].PATIENT_IDs_.append(
+                [i.PATIENT_IDs_ for i, out in shards[1:]])
+            X_merge = pd.concat([out for i, out in shards],
+                                ignore_index=True)
+            if not low_memory:
+                self.X_time = pd.concat([i.X_time for i, out in shards],
+                                        ignore_index=True)
+                self.X_static = pd.concat([i.X_static for i, out in shards])
+                self.X_merge_ = X_merge
+            return X_merge
+        
+        q99_dict = self.q99_dict
+        if q99_dict is None:
+            q99_dict = load_default('q99_dict')
+        
         # Get time vars and replace -1 with nan
-        self.X_time = get_time(X,
-                               time_vars=self.keep_vars).replace(-1,np.nan)
+        X_time = run_stage('MakeStatic.get_time', get_time, X,
+                           time_vars=self.keep_vars).replace(-1,np.nan)
         # Get static vars and replace -1 with nan
-        self.X_static = get_static(X, 
-                                   static_vars).replace(-1,np.nan)
+        X_static = run_stage('MakeStatic.get_static', get_static, X, 
+                             static_vars).replace(-1,np.nan)
         
         # Drop extreme values
         for var in self.keep_vars:
-            self.X_time.loc[self.X_time[var] > self.q99_dict[var],
-                            var] = np.nan
-        self.X_static.loc[self.X_static['Height'] > self.q99_dict['Height'],
-                         'Height'] = np.nan
-        self.X_static.loc[self.X_static['Age'] > self.q99_dict['Age'],
-                         'Age'] = np.nan
+            X_time.loc[X_time[var] > q99_dict[var], var] = np.nan
+        X_static.loc[X_static['Height'] > q99_dict['Height'],
+                     'Height'] = np.nan
+        X_static.loc[X_static['Age'] > q99_dict['Age'], 'Age'] = np.nan
         # Impute Gender
-        self.X_static['Gender'].fillna(1, inplace=True)
+        X_static['Gender'] = X_static['Gender'].fillna(1)
         # Add pao2_fio2_r and Hours to time
-        self.X_time['pao2_fio2_r'] = self.X_time['PaO2']/self.X_time['FiO2']
-        self.X_time['Hours'] = [float(i.split(':')[0]) + 
-                                float(i.split(':')[1])/60 
-                                for i in self.X_time.Time]
+        X_time['pao2_fio2_r'] = X_time['PaO2']/X_time['FiO2']
+        X_time['Hours'] = run_stage('MakeStatic.parse_hours',
+                                    parse_hours, X_time.Time)
         # Drop RecordID
-        self.X_static.drop('RecordID', axis=1, inplace=True)
+        X_static = X_static.drop('RecordID', axis=1)
         # Save PATIENT_ID order for reference
-        self.PATIENT_IDs_ = self.X_static.index
+        self.PATIENT_IDs_ = X_static.index
         
         # Make static frames for day_var, stay_dense, stay_sparse, trends
         # and combine with static
-        self.X_merge_ = pd.concat([
-            self.X_static.reset_index(drop=True),
-            day_var_extract(self.X_time, 
-                            [i for j in [self.day_vars, 
-                                         self.seq_vars] for i in j]),
-            stay_dense_extract(self.X_time, self.stay_dense),
-            stay_sparse_extract(self.X_time, 
-                                self.stay_sparse, 
-                                self.stay_sparse_dict),
-            extract_trends(self.X_time, 
-                           [i for j in 
-                           [self.stay_dense, 
-                            self.day_vars, 
-                            self.seq_vars] 
-                           for i in j])
+        X_merge = pd.concat([
+            X_static.reset_index(drop=True),
+            run_stage('MakeStatic.day_var_extract', day_var_extract,
+                      X_time, 
+                      [i for j in [self.day_vars, 
+                                   self.seq_vars] for i in j]),
+            run_stage('MakeStatic.stay_dense_extract', stay_dense_extract,
+                      X_time, self.stay_dense),
+            run_stage('MakeStatic.stay_sparse_extract', stay_sparse_extract,
+                      X_time, 
+                      self.stay_sparse, 
+                      self.stay_sparse_dict),
+            run_stage('MakeStatic.extract_trends', extract_trends,
+                      X_time, 
+                      [i for j in 
+                      [self.stay_dense, 
+                       self.day_vars, 
+                       self.seq_vars] 
+                      for i in j])
         ], axis=1)
-
+        
+        if low_memory:
+            return run_stage('MakeStatic.compact_features', 
+                             compact_features, X_merge, code_vars)
+        self.X_time = X_time
+        self.X_static = X_static
+        self.X_merge_ = X_merge
         return self.X_merge_
     
 class MakeSeq(BaseEstimator, TransformerMixin):
-    '''returns df with sequences'''
-    def __init__(self, seq_vars, interval=4, mean_seq=mean_seq):
+    '''returns df with sequences. n_jobs > 1 (or -1 for all cores) splits
+    patients across a process pool.'''
+    def __init__(self, seq_vars, interval=4, mean_seq=None, n_jobs=1):
         self.seq_vars = seq_vars
         self.mean_seq = mean_seq
         self.interval = interval
+        self.n_jobs = n_jobs
     
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, y=None):
-        self.X_seq = get_time(X, self.seq_vars)
-        self.X_seq['Hours'] = [float(i.split(':')[0]) + 
-                                float(i.split(':')[1])/60 
-                                for i in self.X_seq.Time]
-        self.X_seq = collapse_time(self.X_seq,
-                                   self.seq_vars, 
-                                   self.interval)
+        if getattr(self, 'n_jobs', 1) not in (0, 1):
+            shards = run_stage('MakeSeq.sharded_transform',
+                               sharded_transform, self, X, self.n_jobs)
+            self.X_seq = pd.concat([out for i, out in shards],
+                                   ignore_index=True)
+            return self.X_seq
+        
+        self.X_seq = run_stage('MakeSeq.get_time', get_time, X,
+                               self.seq_vars)
+        self.X_seq['Hours'] = run_stage('MakeSeq.parse_hours', parse_hours,
+                                        self.X_seq.Time)
+        self.X_seq = run_stage('MakeSeq.collapse_time', collapse_time,
+                               self.X_seq,
+                               self.seq_vars, 
+                               self.interval)
 #         Impute missing seqs with mean seq
-        self.X_seq = seq_impute(self.X_seq,
+        mean_seq = self.mean_seq
+        if mean_seq is None:
+            mean_seq = load_default('mean_seq')
+        self.X_seq = run_stage('MakeSeq.seq_impute', seq_impute,
+                               self.X_seq,
                                [i+'_mean' for i in self.seq_vars],
-                               self.mean_seq)
+                               mean_seq)
         return self.X_seq
 
 class OneHotImpute(BaseEstimator, TransformerMixin):
     '''performs one-hot encoding for categoricals and then imputes median
-    for other vars'''
-    def __init__(self, one_hot_vars):
+    for other vars. low_memory returns float32 with sparse one-hot columns
+    (see densify) and does not keep X_.'''
+    def __init__(self, one_hot_vars, low_memory=False):
         self.one_hot_vars = one_hot_vars
+        self.low_memory = low_memory
         
     def fit(self, X, y=None):
         self.oh = OneHotEncoder(categories='auto',sparse=False)
@@ -392,37 +676,121 @@ class OneHotImpute(BaseEstimator, TransformerMixin):
         return self
     
     def transform(self, X, y=None):
+        if getattr(self, 'low_memory', False):
+            self.__dict__.pop('X_', None)
+            return pd.concat([
+                pd.DataFrame.sparse.from_spmatrix(
+                    run_stage('OneHotImpute.one_hot', sparse_one_hot,
+                              self.oh, X.loc[:, self.one_hot_vars]),
+                    columns = self.oh.get_feature_names()
+                ),
+                pd.DataFrame(
+                    run_stage('OneHotImpute.median_impute', self.si.transform,
+                              X.loc[:, self.med_impute_vars]),
+                    columns = self.med_impute_vars
+                ).astype(np.float32)
+            ], axis=1)
+        
         self.X_ = pd.concat([
             pd.DataFrame(
-                self.oh.transform(X.loc[:, self.one_hot_vars]),
+                run_stage('OneHotImpute.one_hot', self.oh.transform,
+                          X.loc[:, self.one_hot_vars]),
                 columns = self.oh.get_feature_names()
             ),
             pd.DataFrame(
-                self.si.transform(X.loc[:, self.med_impute_vars]),
+                run_stage('OneHotImpute.median_impute', self.si.transform,
+                          X.loc[:, self.med_impute_vars]),
                 columns = X.loc[:, self.med_impute_vars].columns
             )
         ], axis=1)
         return self.X_
     
-raw_df = pd.read_csv('test_data.csv')
-
-pipe = pickle.load(open('pipe_transform.pickle', 'rb'))
-std_scale = pickle.load(open('standard_scaler.pickle', 'rb'))
-xgb_drop = pickle.load(open('xgb_drop.pickle', 'rb'))
-xgb_model = pickle.load(open('final_class.pickle', 'rb'))
-
-pipe_df = pipe.transform(raw_df)
-
-std_df = std_scale.transform(pipe_df)
+def iter_patient_chunks(path, chunksize):
+    '''Yields raw long-format chunks of about chunksize rows without
+    splitting a PATIENT_ID across chunks. Rows for each patient must be
+    contiguous in the file (as in the challenge files).'''
+    carry = None
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        # Hold back the last patient, it may continue in the next chunk
+        tail = np.array(chunk.PATIENT_ID==chunk.PATIENT_ID.iloc[-1])
+        carry = chunk.loc[tail]
+        if not tail.all():
+            yield chunk.loc[~tail]
+    if carry is not None:
+        yield carry
 
-std_df = pd.DataFrame(std_df, columns=pipe_df.columns)
-drop_df = std_df.drop(xgb_drop, axis=1)
-
-preds = xgb_model.predict(drop_df.to_numpy())
+def predict(raw_df, pipe, std_scale, xgb_drop, xgb_model):
+    '''Returns df of PATIENT_ID and predictions for a raw long-format df'''
+    # Sparse one-hot columns (low_memory) are densified only here, at the
+    # model boundary
+    pipe_df = densify(pipe.transform(raw_df))
+    
+    std_df = std_scale.transform(pipe_df)
+    
+    std_df = pd.DataFrame(std_df, columns=pipe_df.columns)
+    drop_df = std_df.drop(xgb_drop, axis=1)
+    
+    preds = xgb_model.predict(drop_df.to_numpy())
+    
+    return pd.DataFrame({
+        'PATIENT_ID': pipe.named_steps['make_static'].PATIENT_IDs_,
+        'Predictions': preds
+    })
 
-pred_df = pd.DataFrame({
-    'PATIENT_ID': raw_df.PATIENT_ID.unique(),
-    'Predictions': preds
-})
+def score_csv(input_path, output_path, chunksize, pipe, std_scale,
+              xgb_drop, xgb_model):
+    '''Scores a raw long-format csv and writes predictions csv, streaming
+    patient-aligned chunks if chunksize is given'''
+    if chunksize is None:
+        raw_df = pd.read_csv(input_path)
+        pred_df = predict(raw_df, pipe, std_scale, xgb_drop, xgb_model)
+        pred_df.to_csv(output_path, index=False)
+    else:
+        # Append predictions as each chunk is scored
+        for i, raw_chunk in enumerate(iter_patient_chunks(input_path,
+                                                          chunksize)):
+            pred_df = predict(raw_chunk, pipe, std_scale, xgb_drop,
+                              xgb_model)
+            pred_df.to_csv(output_path, index=False,
+                           mode='w' if i==0 else 'a', header=i==0)
 
-pred_df.to_csv('test_predictions.csv', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Get in-hospital mortality predictions')
+    parser.add_argument('--input', default='test_data.csv')
+    parser.add_argument('--output', default='test_predictions.csv')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the input in patient-aligned chunks '
+                        'of about this many rows')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='processes for feature extraction '
+                        '(-1 for all cores)')
+    parser.add_argument('--bundle', default='model_bundle',
+                        help='model bundle directory (see model_bundle.py), '
+                        'the pickles are used if it does not exist')
+    parser.add_argument('--low_memory', action='store_true',
+                        help='float32 features, sparse one-hot and no '
+                        'retained intermediates')
+    parser.add_argument('--profile', default=None,
+                        help='write per-stage timings/memory to this csv')
+    args = parser.parse_args()
+    
+    # The loaded transformers belong to the imported module, not __main__,
+    # so switch modes and profile through it
+    import get_predictions
+    from model_bundle import load_models
+    pipe, std_scale, xgb_drop, xgb_model = load_models(args.bundle)
+    pipe.named_steps['make_static'].n_jobs = args.n_jobs
+    get_predictions.set_low_memory(pipe, args.low_memory)
+    
+    if args.profile:
+        with get_predictions.profile_stages() as profiler:
+            score_csv(args.input, args.output, args.chunksize,
+                      pipe, std_scale, xgb_drop, xgb_model)
+        profiler.report().to_csv(args.profile, index=False)
+    else:
+        score_csv(args.input, args.output, args.chunksize,
+                  pipe, std_scale, xgb_drop, xgb_model)
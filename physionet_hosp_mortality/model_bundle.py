@@ -0,0 +1,226 @@
+'''Versioned model bundle for get_predictions.py.
+
+A bundle is a directory with a manifest.json (variable lists, fitted
+parameters, checksums), .npy arrays that are memory-mapped on load, and the
+XGBoost classifier in its native format. Nothing in it is unpickled, and each
+artifact is only read (and checksum verified) the first time it is used.
+
+To convert the pickles in this folder to a bundle, run:
+    python model_bundle.py
+'''
+import hashlib
+import json
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.impute import SimpleImputer
+
+import get_predictions
+from get_predictions import MakeStatic, OneHotImpute
+
+BUNDLE_FORMAT = 'physionet-mortality'
+BUNDLE_VERSION = 1
+
+def file_checksum(path):
+    '''sha256 of file contents'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class MainUnpickler(pickle.Unpickler):
+    '''Resolves classes pickled from a notebook/script (__main__) against
+    get_predictions, so legacy pickles load from any entry point'''
+    def find_class(self, module, name):
+        if module == '__main__' and hasattr(get_predictions, name):
+            return getattr(get_predictions, name)
+        return super().find_class(module, name)
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return MainUnpickler(f).load()
+
+def export_bundle(path, pipe, std_scale, xgb_drop, xgb_model, q99_dict,
+                  mean_seq):
+    '''Writes fitted scoring artifacts to a bundle directory at path'''
+    os.makedirs(path, exist_ok=True)
+    make_static = pipe.named_steps['make_static']
+    onehot_impute = pipe.named_steps['onehot_impute']
+
+    arrays = {
+        'mean_seq': np.asarray(mean_seq, dtype=float),
+        'scaler_mean': np.asarray(std_scale.mean_, dtype=float),
+        'scaler_var': np.asarray(std_scale.var_, dtype=float),
+        'scaler_scale': np.asarray(std_scale.scale_, dtype=float),
+        'imputer_statistics': np.asarray(onehot_impute.si.statistics_,
+                                         dtype=float),
+    }
+    files = {}
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+        files[name] = name + '.npy'
+    xgb_model.save_model(os.path.join(path, 'final_class.ubj'))
+    files['xgb_model'] = 'final_class.ubj'
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'make_static': {
+            'keep_vars': list(make_static.keep_vars),
+            'static_vars': list(make_static.static_vars),
+            'seq_vars': list(make_static.seq_vars),
+            'day_vars': list(make_static.day_vars),
+            'stay_dense': list(make_static.stay_dense),
+            'stay_sparse': list(make_static.stay_sparse),
+            'stay_sparse_dict': {k: [float(i) for i in v] for k, v in
+                                 make_static.stay_sparse_dict.items()},
+        },
+        'q99_dict': {k: float(v) for k, v in q99_dict.items()},
+        'mean_seq': {'index': [float(i) for i in mean_seq.index],
+                     'index_name': mean_seq.index.name,
+                     'columns': list(mean_seq.columns)},
+        'onehot_impute': {
+            'one_hot_vars': list(onehot_impute.one_hot_vars),
+            'categories': [i.tolist() for i in
+                           onehot_impute.oh.categories_],
+            'med_impute_vars': list(onehot_impute.med_impute_vars),
+        },
+        'scaler': {'n_samples_seen': int(np.max(std_scale.n_samples_seen_))},
+        'xgb_drop': list(xgb_drop),
+        'files': files,
+        'checksums': {name: file_checksum(os.path.join(path, f))
+                      for name, f in files.items()},
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+class ModelBundle(object):
+    '''Lazily loaded scoring artifacts. Attributes (pipe, std_scale,
+    xgb_drop, xgb_model, q99_dict, mean_seq) are built on first access.'''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != BUNDLE_FORMAT:
+            raise ValueError('not a model bundle: ' + path)
+        if self.manifest.get('version') != BUNDLE_VERSION:
+            raise ValueError('unsupported bundle version: ' +
+                             str(self.manifest.get('version')))
+        self._cache = {}
+
+    def _file(self, name):
+        '''Returns path of a bundle file after verifying its checksum'''
+        path = os.path.join(self.path, self.manifest['files'][name])
+        if file_checksum(path) != self.manifest['checksums'][name]:
+            raise ValueError('checksum mismatch for ' + path)
+        return path
+
+    def _array(self, name):
+        return np.load(self._file(name), mmap_mode='r')
+
+    def _lazy(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    @property
+    def q99_dict(self):
+        return self._lazy('q99_dict', lambda: dict(self.manifest['q99_dict']))
+
+    @property
+    def mean_seq(self):
+        def build():
+            meta = self.manifest['mean_seq']
+            index = pd.Index(meta['index'], name=meta['index_name'])
+            if (index == index.astype(int)).all():
+                index = index.astype(int)
+            return pd.DataFrame(np.array(self._array('mean_seq')),
+                                index=index, columns=meta['columns'])
+        return self._lazy('mean_seq', build)
+
+    @property
+    def xgb_drop(self):
+        return self._lazy('xgb_drop', lambda: list(self.manifest['xgb_drop']))
+
+    @property
+    def pipe(self):
+        def build():
+            params = self.manifest['make_static']
+            meta = self.manifest['onehot_impute']
+            make_static = MakeStatic(q99_dict=self.q99_dict, **params)
+
+            # Refit encoder/imputer on rows that reproduce the stored state
+            onehot_impute = OneHotImpute(meta['one_hot_vars'])
+            categories = meta['categories']
+            n_rows = max(len(i) for i in categories)
+            onehot_impute.oh = OneHotEncoder(
+                categories=[np.array(i) for i in categories], sparse=False)
+            onehot_impute.oh.fit(pd.DataFrame(
+                {var: [cats[i % len(cats)] for i in range(n_rows)]
+                 for var, cats in zip(meta['one_hot_vars'], categories)}))
+            onehot_impute.med_impute_vars = meta['med_impute_vars']
+            onehot_impute.si = SimpleImputer(missing_values=np.nan,
+                                             strategy='median')
+            onehot_impute.si.fit(pd.DataFrame(
+                [np.array(self._array('imputer_statistics'))],
+                columns=meta['med_impute_vars']))
+
+            return Pipeline([
+                ('make_static', make_static),
+                ('onehot_impute', onehot_impute),
+            ])
+        return self._lazy('pipe', build)
+
+    @property
+    def std_scale(self):
+        def build():
+            std_scale = StandardScaler()
+            std_scale.mean_ = self._array('scaler_mean')
+            std_scale.var_ = self._array('scaler_var')
+            std_scale.scale_ = self._array('scaler_scale')
+            std_scale.n_samples_seen_ = self.manifest['scaler'][
+                'n_samples_seen']
+            std_scale.n_features_in_ = len(std_scale.mean_)
+            return std_scale
+        return self._lazy('std_scale', build)
+
+    @property
+    def xgb_model(self):
+        def build():
+            from xgboost import XGBClassifier
+            xgb_model = XGBClassifier()
+            xgb_model.load_model(self._file('xgb_model'))
+            return xgb_model
+        return self._lazy('xgb_model', build)
+
+def load_models(path='model_bundle'):
+    '''Returns (pipe, std_scale, xgb_drop, xgb_model) from the bundle at path,
+    or from the pickles in the working directory if there is no bundle'''
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        bundle = ModelBundle(path)
+        return (bundle.pipe, bundle.std_scale, bundle.xgb_drop,
+                bundle.xgb_model)
+    return (load_pickle('pipe_transform.pickle'),
+            load_pickle('standard_scaler.pickle'),
+            load_pickle('xgb_drop.pickle'),
+            load_pickle('final_class.pickle'))
+
+if __name__ == '__main__':
+    out_path = sys.argv[1] if len(sys.argv) > 1 else 'model_bundle'
+    manifest = export_bundle(
+        out_path,
+        pipe=load_pickle('pipe_transform.pickle'),
+        std_scale=load_pickle('standard_scaler.pickle'),
+        xgb_drop=load_pickle('xgb_drop.pickle'),
+        xgb_model=load_pickle('final_class.pickle'),
+        q99_dict=load_pickle('q99_dict.pickle'),
+        mean_seq=load_pickle('mean_seq.pickle'),
+    )
+    print('wrote', out_path, 'with', len(manifest['files']), 'files')
@@ -0,0 +1,333 @@
+'''Incremental MakeStatic features for real-time monitoring.
+
+FeatureStore keeps running aggregates per PATIENT_ID, so a patient can be
+re-scored as new (Time, Parameter, Value) observations arrive without
+re-reading the whole stay. features() returns the same columns as
+MakeStatic.transform, ready for the rest of the pipeline, e.g.:
+
+    store = FeatureStore(q99_dict)
+    store.ingest(132539, '00:07', 'HR', 73)
+    ...
+    X = store.features([132539])
+    drop_df = std_scale.transform(pipe.named_steps['onehot_impute'].transform(X))
+
+Observations for a patient must arrive in time order. Observations at the
+same Time are collected into one row (duplicates reduced with min, as in
+get_time) and folded into the aggregates once a later Time arrives.
+features() includes the open row without folding it in, so re-scoring
+between two observations at the same Time is fine.
+'''
+import heapq
+import numpy as np
+import pandas as pd
+
+from get_predictions import (keep_vars, static_vars, seq_vars, day_vars,
+                             stay_dense, stay_sparse, stay_sparse_dict,
+                             summary_stats, bounds_table, time_bins)
+
+class RunningMedian(object):
+    '''Median of a growing set with two heaps (log n insert, O(1) median)'''
+    def __init__(self):
+        self.lower = []  # max-heap (negated)
+        self.upper = []  # min-heap
+
+    def add(self, x):
+        if self.lower and x > -self.lower[0]:
+            heapq.heappush(self.upper, x)
+        else:
+            heapq.heappush(self.lower, -x)
+        if len(self.lower) > len(self.upper) + 1:
+            heapq.heappush(self.upper, -heapq.heappop(self.lower))
+        elif len(self.upper) > len(self.lower):
+            heapq.heappush(self.lower, -heapq.heappop(self.upper))
+
+    def median(self):
+        if not self.lower:
+            return np.nan
+        if len(self.lower) > len(self.upper):
+            return -self.lower[0]
+        return (-self.lower[0] + self.upper[0])/2
+
+    def median_with(self, x):
+        '''Median as if x were added, from the heap tops (the set is not
+        changed)'''
+        if not self.lower:
+            return x
+        top = -self.lower[0]
+        if len(self.lower) > len(self.upper):
+            # Odd count: x and its neighbour below or above top are the
+            # middle pair
+            if x >= top:
+                return (top + min(x, self.upper[0]) if self.upper
+                        else top + x)/2
+            below = -min(self.lower[1:3]) if len(self.lower) > 1 else x
+            return (top + max(x, below))/2
+        # Even count: x clamped between the two middle values
+        return min(max(x, top), self.upper[0])
+
+class RunningStats(object):
+    '''min, max, median, first, last and n of non-missing values'''
+    def __init__(self):
+        self.min = np.inf
+        self.max = -np.inf
+        self.med = RunningMedian()
+        self.first = np.nan
+        self.last = np.nan
+        self.n = 0
+
+    def add(self, x):
+        if self.n == 0:
+            self.first = x
+        self.last = x
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        self.med.add(x)
+        self.n += 1
+
+    def values(self):
+        if self.n == 0:
+            return [np.nan]*5 + [0.]
+        return [self.min, self.max, self.med.median(), self.first,
+                self.last, float(self.n)]
+
+    def values_with(self, x):
+        '''values() as if x were added (without adding it)'''
+        if self.n == 0:
+            return [x, x, x, x, x, 1.]
+        return [min(self.min, x), max(self.max, x), self.med.median_with(x),
+                self.first, x, float(self.n + 1)]
+
+class RunningTrend(object):
+    '''OLS slope of y on x from running (Welford) co-moments'''
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.
+        self.mean_y = 0.
+        self.cov_xy = 0.
+        self.var_x = 0.
+
+    def add(self, x, y):
+        self.n += 1
+        dx = x - self.mean_x
+        self.mean_x += dx/self.n
+        self.mean_y += (y - self.mean_y)/self.n
+        self.cov_xy += dx*(y - self.mean_y)
+        self.var_x += dx*(x - self.mean_x)
+
+    def slope(self):
+        if self.n <= 1 or self.var_x == 0:
+            return np.nan
+        return self.cov_xy/self.var_x
+
+    def slope_with(self, x, y):
+        '''slope() as if (x, y) were added (without adding it)'''
+        n = self.n + 1
+        dx = x - self.mean_x
+        mean_x = self.mean_x + dx/n
+        mean_y = self.mean_y + (y - self.mean_y)/n
+        cov_xy = self.cov_xy + dx*(y - mean_y)
+        var_x = self.var_x + dx*(x - mean_x)
+        if n <= 1 or var_x == 0:
+            return np.nan
+        return cov_xy/var_x
+
+class PatientState(object):
+    '''Running feature state for one patient'''
+    def __init__(self, day_bins, day_list, dense_list, trend_list,
+                 sparse_list):
+        self.static = {}
+        self.pending_time = None
+        self.pending_hours = None
+        self.pending = {}
+        self.last_hours = -np.inf
+        self.day = {var: [RunningStats() for b in day_bins]
+                    for var in day_list}
+        self.dense = {var: RunningStats() for var in dense_list}
+        self.trend = {var: RunningTrend() for var in trend_list}
+        self.sparse = {var: None for var in sparse_list}
+
+def time_to_hours(time):
+    '''Hours for an 'HH:MM' string (or a number of hours)'''
+    if isinstance(time, str):
+        hh, mm = time.split(':')
+        return float(hh) + float(mm)/60
+    return float(time)
+
+class FeatureStore(object):
+    '''Incremental MakeStatic features keyed by PATIENT_ID. Arguments match
+    MakeStatic (q99_dict is required).'''
+    def __init__(self, q99_dict, keep_vars=keep_vars,
+                 static_vars=static_vars,
+                 seq_vars=seq_vars,
+                 day_vars=day_vars,
+                 stay_dense=stay_dense,
+                 stay_sparse=stay_sparse,
+                 stay_sparse_dict=stay_sparse_dict):
+        self.q99_dict = q99_dict
+        self.keep_vars = set(keep_vars)
+        self.static_vars = static_vars
+        self.day_list = list(day_vars) + list(seq_vars)
+        self.dense_list = list(stay_dense)
+        self.trend_list = list(stay_dense) + list(day_vars) + list(seq_vars)
+        self.sparse_list = list(stay_sparse)
+        lower, upper = bounds_table(stay_sparse_dict, self.sparse_list)
+        self.sparse_bounds = dict(zip(self.sparse_list, zip(lower, upper)))
+        _, _, self.day_bins = time_bins([], 24, 'hour')
+        self.patients = {}
+
+    def _state(self, patient_id):
+        if patient_id not in self.patients:
+            self.patients[patient_id] = PatientState(
+                self.day_bins, self.day_list, self.dense_list,
+                self.trend_list, self.sparse_list)
+        return self.patients[patient_id]
+
+    def ingest(self, patient_id, time, parameter, value):
+        '''Adds one raw observation (Time as 'HH:MM')'''
+        state = self._state(patient_id)
+        value = float(value)
+        if parameter in self.static_vars and time in ('00:00', 0):
+            state.static[parameter] = value
+        if parameter not in self.keep_vars:
+            return
+
+        hours = time_to_hours(time)
+        if hours <= state.last_hours or (state.pending_time is not None and
+                                         hours < state.pending_hours):
+            raise ValueError('observations for patient %s must arrive in '
+                             'time order (got %s)' % (patient_id, time))
+        if state.pending_time is not None and hours > state.pending_hours:
+            self._flush(state)
+        state.pending_time = time
+        state.pending_hours = hours
+        # Duplicate obs at one Time are reduced with min (as get_time)
+        old = state.pending.get(parameter)
+        if old is None or np.isnan(old):
+            state.pending[parameter] = value
+        elif not np.isnan(value):
+            state.pending[parameter] = min(old, value)
+
+    def ingest_df(self, raw_df):
+        '''Adds every row of a raw long-format df, in file order'''
+        for row in raw_df[['PATIENT_ID', 'Time', 'Parameter',
+                           'Value']].itertuples(index=False):
+            self.ingest(*row)
+
+    def _clean(self, var, value):
+        if value == -1 or value > self.q99_dict[var]:
+            return np.nan
+        return value
+
+    def _pending_row(self, state):
+        '''Cleaned pending row (with pao2_fio2_r) and its day bin'''
+        row = {var: self._clean(var, value)
+               for var, value in state.pending.items()}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            row['pao2_fio2_r'] = np.float64(row.get('PaO2', np.nan)) / \
+                np.float64(row.get('FiO2', np.nan))
+        _, bin_idx, _ = time_bins([state.pending_hours], 24, 'hour')
+        return row, bin_idx[0]
+
+    def _sparse_code(self, var, value):
+        lower, upper = self.sparse_bounds[var]
+        return 0 if np.isnan(value) else 1 if lower <= value <= upper else 2
+
+    def _flush(self, state):
+        '''Folds the pending row (all obs at one Time) into the aggregates'''
+        row, bin_idx = self._pending_row(state)
+        hours = state.pending_hours
+
+        for var, stats in state.day.items():
+            value = row.get(var, np.nan)
+            if bin_idx >= 0 and not np.isnan(value):
+                stats[bin_idx].add(value)
+        for var, stats in state.dense.items():
+            value = row.get(var, np.nan)
+            if not np.isnan(value):
+                stats.add(value)
+        for var, trend in state.trend.items():
+            value = row.get(var, np.nan)
+            if not np.isnan(value):
+                trend.add(hours, value)
+        for var in state.sparse:
+            code = self._sparse_code(var, row.get(var, np.nan))
+            state.sparse[var] = code if state.sparse[var] is None \
+                else max(state.sparse[var], code)
+
+        state.last_hours = hours
+        state.pending_time = None
+        state.pending_hours = None
+        state.pending = {}
+
+    def columns(self):
+        static_cols = [i for i in sorted(self.static_vars)
+                       if i != 'RecordID']
+        return (static_cols +
+                [var+'_'+i+'_'+str(b) for var in self.day_list
+                 for b in self.day_bins for i in summary_stats] +
+                [var+'_'+i for var in self.dense_list
+                 for i in summary_stats] +
+                [i+'_cats' for i in self.sparse_list] +
+                [i+'_trend' for i in self.trend_list])
+
+    def _static_values(self, state):
+        values = []
+        for var in sorted(self.static_vars):
+            if var == 'RecordID':
+                continue
+            value = state.static.get(var, np.nan)
+            if value == -1:
+                value = np.nan
+            if var in ('Height', 'Age') and value > self.q99_dict[var]:
+                value = np.nan
+            if var == 'Gender' and np.isnan(value):
+                value = 1.
+            values.append(value)
+        return values
+
+    def features(self, patient_ids=None):
+        '''Returns MakeStatic-style feature df for patient_ids (default:
+        all patients, in PATIENT_ID order). Pending observations are
+        included but stay open, so more obs at the same Time can follow.'''
+        if patient_ids is None:
+            patient_ids = sorted(self.patients)
+        rows = []
+        for patient_id in patient_ids:
+            state = self.patients[patient_id]
+            # The pending row's values are added on the fly (the aggregates
+            # only change when a later Time closes the row)
+            pending, bin_idx = {}, -1
+            if state.pending_time is not None:
+                pending, bin_idx = self._pending_row(state)
+            row = self._static_values(state)
+            for var in self.day_list:
+                value = pending.get(var, np.nan)
+                for b, stats in enumerate(state.day[var]):
+                    row.extend(stats.values_with(value)
+                               if b == bin_idx and not np.isnan(value)
+                               else stats.values())
+            for var in self.dense_list:
+                value = pending.get(var, np.nan)
+                row.extend(state.dense[var].values() if np.isnan(value)
+                           else state.dense[var].values_with(value))
+            for var in self.sparse_list:
+                code = state.sparse[var]
+                if state.pending_time is not None:
+                    new = self._sparse_code(var, pending.get(var, np.nan))
+                    code = new if code is None else max(code, new)
+                row.append(0 if code is None else code)
+            for var in self.trend_list:
+                value = pending.get(var, np.nan)
+                row.append(state.trend[var].slope() if np.isnan(value) else
+                           state.trend[var].slope_with(state.pending_hours,
+                                                       value))
+            rows.append(row)
+
+        features_df = pd.DataFrame(rows, columns=self.columns(), dtype=float)
+        cat_cols = [i+'_cats' for i in self.sparse_list]
+        features_df[cat_cols] = features_df[cat_cols].astype(int)
+        return features_df
+
+    def drop(self, patient_id):
+        '''Forgets a patient (e.g. on discharge)'''
+        self.patients.pop(patient_id, None)
@@ -0,0 +1,113 @@
+'''Long-lived scoring server for in-hospital mortality predictions.
+
+The pipeline, StandardScaler, xgb_drop column list and XGBoost classifier are
+loaded once at startup (from the model bundle, or the pickles) and kept warm.
+
+Start the server from this folder:
+    python serve_predictions.py --port 8000
+
+Endpoints:
+    GET  /health   -> {"status": "ok"}
+    POST /predict  -> body is raw long-format csv (PATIENT_ID,Time,Parameter,
+                      Value) for one or more patients, or json
+                      {"rows": [{"PATIENT_ID": ..., "Time": ..., ...}, ...]}.
+                      Returns {"predictions": [{"PATIENT_ID": ...,
+                      "Prediction": ...}, ...]}
+
+bench_server.py is a throughput/latency benchmark client for it.
+'''
+import argparse
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import pandas as pd
+
+from get_predictions import predict
+from model_bundle import load_models
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Scorer(object):
+    '''Holds warm models. The transformers keep per-call state (e.g.
+    PATIENT_IDs_), so scoring calls are serialized with a lock.'''
+    def __init__(self, bundle='model_bundle'):
+        (self.pipe, self.std_scale,
+         self.xgb_drop, self.xgb_model) = load_models(bundle)
+        self.lock = threading.Lock()
+
+    def score(self, raw_df):
+        with self.lock:
+            pred_df = predict(raw_df, self.pipe, self.std_scale,
+                              self.xgb_drop, self.xgb_model)
+        return [{'PATIENT_ID': int(i), 'Prediction': int(p)}
+                for i, p in zip(pred_df.PATIENT_ID, pred_df.Predictions)]
+
+def parse_body(body, content_type):
+    '''Returns raw long-format df from a csv or json request body'''
+    if content_type.startswith('application/json'):
+        return pd.DataFrame(json.loads(body.decode('utf-8'))['rows'])
+    return pd.read_csv(io.BytesIO(body))
+
+def make_handler(scorer):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            out = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': 'not found'})
+                return
+            start = time.time()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                raw_df = parse_body(body,
+                                    self.headers.get('Content-Type', ''))
+                predictions = scorer.score(raw_df)
+            except Exception as e:
+                self._send_json(400, {'error': repr(e)})
+                return
+            self._send_json(200, {'predictions': predictions,
+                                  'seconds': time.time() - start})
+
+        def log_message(self, format, *args):
+            # Keep request logging off the hot path
+            pass
+
+    return PredictionHandler
+
+def serve(host='127.0.0.1', port=8000, bundle='model_bundle'):
+    scorer = Scorer(bundle)
+    server = ThreadingHTTPServer((host, port), make_handler(scorer))
+    print('serving predictions on http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve in-hospital mortality predictions over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--bundle', default='model_bundle',
+                        help='model bundle directory (see model_bundle.py), '
+                        'the pickles are used if it does not exist')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.bundle)